@@ -4,55 +4,140 @@ Topic Analysis functionality for the Always Remember project.
 Dan Morris 11/3/14 - 11/20/14
 '''
 import pickle
+from datetime import date
 import numpy as np
 import pandas as pd
-from mongo_stuff import just_clean_text
-from collections import Counter
+from mongo_stuff import just_clean_text, batches, records_by_id
+from collections import Counter, deque
+from multiprocessing import Pool, cpu_count
+from pymongo import UpdateOne
+from feature_store import save_topic_weights, TopicWeightStore, \
+    save_model_artifacts, load_vectorizer, load_topic_matrix, \
+    load_topic_filter, encode_topic_weights, decode_topic_weights, \
+    TopicCube, _artifact_file
 import simplejson as json
 
+# article fields the D3 front-end shows
+ARTICLE_FIELDS = ['pub_date', 'lead_paragraph', 'headline', 'web_url']
+
 
 class TopicAnalyzer(object):
     '''
     Loads the vectorizer and H matrix necessary for document topic analysis.
     Performs large-scale analysis on the corpus.
+    The model is loaded lazily, the first time vectorizer or H is used.
+        Use from_artifacts for a model saved with save_artifacts: H is
+        then memory-mapped, so analyzers on one host share its pages.
 
     INPUT:  filelike - vec_file vectorizer, filelike - H topic-term matrix,
             np array - topic_filter booleans
     '''
     def __init__(self, vec_file, H_file, topic_filter=None):
-        self.vectorizer = pickle.load(open(vec_file))
         self.topic_filter = topic_filter
-        H = pickle.load(open(H_file))
-        if topic_filter is not None:
-            self.H = H[topic_filter]
-        else:
-            self.H = H
-        self.num_topics = self.H.shape[0]
+        self._vec_file = vec_file
+        self._H_file = H_file
+        self._artifacts = None
+        self._vectorizer = None
+        self._H = None
+
+    @classmethod
+    def from_artifacts(cls, path):
+        '''
+        Makes an analyzer for a model saved by save_artifacts (or
+            feature_store.save_model_artifacts).
+
+        INPUT:  string - path
+        OUTPUT: TopicAnalyzer
+        '''
+        analyzer = cls(None, None, load_topic_filter(path))
+        analyzer._artifacts = path
+        return analyzer
+
+    @property
+    def vectorizer(self):
+        '''
+        The fitted vectorizer, loaded on first use.
+        '''
+        if self._vectorizer is None:
+            if self._artifacts is not None:
+                self._vectorizer = load_vectorizer(self._artifacts)
+            else:
+                with open(self._vec_file) as f:
+                    self._vectorizer = pickle.load(f)
+        return self._vectorizer
+
+    @property
+    def H(self):
+        '''
+        The topic-term matrix (topic_filter rows only), loaded on first use.
+        '''
+        if self._H is None:
+            if self._artifacts is not None:
+                self._H = load_topic_matrix(self._artifacts)
+            else:
+                with open(self._H_file) as f:
+                    H = pickle.load(f)
+                if self.topic_filter is not None:
+                    H = H[self.topic_filter]
+                self._H = H
+        return self._H
 
+    @property
+    def num_topics(self):
+        '''
+        Number of topics kept by topic_filter.
+        '''
+        return self.H.shape[0]
+
+    def save_artifacts(self, path):
+        '''
+        Saves this analyzer's model as memory-mappable arrays for
+            from_artifacts (see feature_store.save_model_artifacts).
+
+        INPUT:  string - path
+        OUTPUT: None
+        '''
+        save_model_artifacts(path, self.vectorizer, self.H)
+        if self.topic_filter is not None:
+            np.save(_artifact_file(path, 'topic_filter'), self.topic_filter)
 
     def topic_freq_by_date_range(self, table, start_date, end_date,
-                                 n_articles=1, topic_freq_threshold=.1):
+                                 n_articles=1, topic_freq_threshold=.1,
+                                 store=None, cube=None):
         '''
         Get topic frequencies for all records in a date range. Also returns
             the highest-matching document(s) if that topic's relative
-            frequency is above the topic_freq_threshold.
+            frequency is above the topic_freq_threshold. Pass a
+            FeatureStore built by this vectorizer to skip mongo and
+            re-vectorizing. Pass a TopicCube (see build_cube) to read
+            the frequencies from its prefix sums instead; no documents
+            are scored then, so there are no example articles (None).
 
         INPUT:  mongo-collection - table, string - start_date,
                 string - end_date, int - n_articles,
-                float - topic_freq_threshold
+                float - topic_freq_threshold, FeatureStore - store,
+                TopicCube - cube
         OUTPUT: list - (topic index, topic frequency, example
                 article(s)) tuples
         '''
-        q = {'pub_date': {'$gte': start_date, '$lte': end_date}}
-        docs = just_clean_text(table, q)
-        article_ids = np.array([d[0] for d in docs])
-        X = self.vectorizer.transform([d[1] for d in docs])
+        if cube is not None:
+            freqs = _normalize_frequencies(
+                cube.range_sum(start_date, end_date, 'weight_sums'))
+            return [(t, freqs[t], None) for t in range(self.num_topics)]
+        if store is not None:
+            store.check(self.vectorizer)
+            X, article_ids, _ = store.date_range(start_date, end_date)
+        else:
+            q = {'pub_date': {'$gte': start_date, '$lte': end_date}}
+            docs = just_clean_text(table, q)
+            article_ids = np.array([d[0] for d in docs])
+            X = self.vectorizer.transform([d[1] for d in docs])
         doc_topic_freqs = X.dot(self.H.T)
         total_topic_freqs = _normalize_frequencies(doc_topic_freqs.sum(axis=0))
         output = [None] * self.num_topics
         for t in range(self.num_topics):
             if total_topic_freqs[t] > topic_freq_threshold:
-                tops = np.argsort(doc_topic_freqs[:, t])[::-1][:n_articles]
+                tops = top_k_indices(doc_topic_freqs[:, t], n_articles)
                 output[t] = (t, total_topic_freqs[t], article_ids[tops])
             else:
                 output[t] = (t, total_topic_freqs[t], None)
@@ -60,25 +145,42 @@ class TopicAnalyzer(object):
 
     def topic_count_by_date_range(self, table, start_date, end_date,
                                   doc_topic_threshold=.1,
-                                  only_best_match=True):
+                                  only_best_match=True, store=None,
+                                  cube=None):
         '''
         Returns a count of articles that match each topic above a certain
             threshold of similarity. More granular and human-interpretable
             than topic_freq_by_date_range. If only_best_match: counts
             articles for which that topic is the best match. Else: counts
-            any article above that threshold per topic.
+            any article above that threshold per topic. Pass a
+            FeatureStore built by this vectorizer to skip mongo and
+            re-vectorizing, or a TopicCube (see build_cube) to answer
+            from its prefix sums without scoring anything.
 
         INPUT:  mongo-collection - table, string - start_date,
                 string - end_date, float - doc_topic_threshold,
-                bool - only_best_match
+                bool - only_best_match, FeatureStore - store,
+                TopicCube - cube
         OUTPUT: np array - count of matching articles per topic
         '''
-        q = {'pub_date': {'$gte': start_date, '$lte': end_date}}
-        docs = just_clean_text(table, q)
-        article_ids = np.array([d[0] for d in docs])
-        texts = [d[1] for d in docs]
-        article_lengths = _get_article_lengths(texts)
-        X = self.vectorizer.transform(texts)
+        if cube is not None:
+            if only_best_match:
+                return cube.range_sum(start_date, end_date, 'best_counts')
+            if doc_topic_threshold != cube.doc_topic_threshold:
+                raise ValueError('cube counts use doc_topic_threshold=%s' %
+                                 cube.doc_topic_threshold)
+            return cube.range_sum(start_date, end_date, 'threshold_counts')
+        if store is not None:
+            store.check(self.vectorizer, lengths=True)
+            X, article_ids, article_lengths = store.date_range(start_date,
+                                                               end_date)
+        else:
+            q = {'pub_date': {'$gte': start_date, '$lte': end_date}}
+            docs = just_clean_text(table, q)
+            article_ids = np.array([d[0] for d in docs])
+            texts = [d[1] for d in docs]
+            article_lengths = _get_article_lengths(texts)
+            X = self.vectorizer.transform(texts)
         doc_topic_freqs = X.dot(self.H.T) / article_lengths
         if only_best_match:
             best_matches = Counter(doc_topic_freqs.argmax(axis=1))
@@ -86,22 +188,143 @@ class TopicAnalyzer(object):
         matches = doc_topic_freqs > doc_topic_threshold
         return matches.sum(axis=0)
 
-    def current_events_analysis(self, table, n_days=7):
+    def build_cube(self, table, query={}, doc_topic_threshold=.1, top_k=3,
+                   store=None, batch_size=10000):
+        '''
+        Scores every article (or those matching query) once and totals
+            them by day in a TopicCube, which then answers
+            topic_freq_by_date_range and topic_count_by_date_range for
+            any date range. Keep it current with add_to_cube, or by
+            passing it to store_topic_weights as new articles are scored.
+
+        INPUT:  mongo-collection - table, dict - mongo query,
+                float - doc_topic_threshold, int - top_k,
+                FeatureStore - store, int - batch_size
+        OUTPUT: TopicCube - cube
+        '''
+        cube = TopicCube(self.num_topics, doc_topic_threshold, top_k)
+        self.add_to_cube(cube, table, query, store, batch_size)
+        return cube
+
+    def add_to_cube(self, cube, table, query={}, store=None,
+                    batch_size=10000):
         '''
-        Finds just articles from the last n_days for special analysis/output
+        Scores the articles matching query in batches and adds them to
+            cube. Only articles published after the cube's last_date are
+            added, so calling this again after a scrape adds just the new
+            articles (ones scraped late with older pub_dates are not).
+            With a FeatureStore built by this vectorizer, adds its rows
+            instead of querying mongo; query can't be applied to a store.
+
+        INPUT:  TopicCube - cube, mongo-collection - table,
+                dict - mongo query, FeatureStore - store, int - batch_size
+        OUTPUT: None
+        '''
+        if store is not None:
+            if query:
+                raise ValueError('add_to_cube cannot apply a query to a '
+                                 'FeatureStore')
+            store.check(self.vectorizer, lengths=True)
+            first = 0
+            if cube.last_date is not None:
+                first = np.searchsorted(store.pub_dates, cube.last_date,
+                                        side='right')
+            for start in xrange(first, len(store), batch_size):
+                stop = min(start + batch_size, len(store))
+                X, _, lengths = store.rows(start, stop)
+                cube.add(store.pub_dates[start:stop], X.dot(self.H.T),
+                         lengths)
+            return
+        q = {'clean_text': {'$exists': True, '$ne': ''}}
+        q.update(query)
+        if cube.last_date is not None:
+            q = {'$and': [q, {'pub_date': {'$gt': cube.last_date}}]}
+        cursor = table.find(q, {'clean_text': 1, 'pub_date': 1})
+        for batch in batches(cursor, batch_size):
+            texts = [r['clean_text'] for r in batch]
+            cube.add([r['pub_date'] for r in batch],
+                     self.vectorizer.transform(texts).dot(self.H.T),
+                     _get_article_lengths(texts))
+
+    def current_events_analysis(self, table, model_name, n_days=7,
+                                cache_dir=None, spike_ratio=2.,
+                                min_articles=3, normalize='linear',
+                                end_date=None, batch_size=1000):
+        '''
+        Finds just articles from the last n_days for special analysis/output:
+            scores the News articles of the n_days ending on end_date
+            (default: the newest article's day) into a
+            CurrentEventsWindow, which flags the topics whose share of
+            the window is at least spike_ratio times their share before
+            it. That baseline comes from model_name's stored weights (or
+            its cache in cache_dir), so normalize should match how they
+            were stored. Keep the returned window current by passing new
+            articles to feed_current_events.
+
+        INPUT:  mongo-collection - table, string - model_name, int - n_days,
+                string - cache_dir, float - spike_ratio,
+                int - min_articles, string - normalizing rule,
+                string - end_date, int - batch_size
+        OUTPUT: list - flagged topics (see CurrentEventsWindow.flagged),
+                CurrentEventsWindow - window
+        '''
+        if end_date is None:
+            newest = table.find_one({'pub_date': {'$exists': True}},
+                                    {'pub_date': 1},
+                                    sort=[('pub_date', -1)])
+            if newest is None:
+                raise ValueError('no articles with a pub_date to end the '
+                                 'window on; pass end_date')
+            end_date = newest['pub_date']
+        last_day = _day_number(end_date)
+        start_date = date.fromordinal(last_day - n_days + 1).isoformat()
+        stop_date = date.fromordinal(last_day + 1).isoformat()
+        baseline = _topic_weight_totals(table, model_name,
+                                        {'$lt': start_date}, cache_dir)
+        window = CurrentEventsWindow(baseline, n_days, spike_ratio,
+                                     min_articles)
+        q = {'pub_date': {'$gte': start_date, '$lt': stop_date},
+             'type_of_material': 'News',
+             'clean_text': {'$exists': True, '$ne': ''}}
+        cursor = table.find(q, {'clean_text': 1, 'pub_date': 1})
+        for batch in batches(cursor, batch_size):
+            self.feed_current_events(window, [r['_id'] for r in batch],
+                                     [r['pub_date'] for r in batch],
+                                     [r['clean_text'] for r in batch],
+                                     normalize)
+        return window.flagged(), window
+
+    def feed_current_events(self, window, ids, pub_dates, texts,
+                            normalize='linear'):
+        '''
+        Scores a batch of new articles with one transform and adds them to
+            a CurrentEventsWindow.
+
+        INPUT:  CurrentEventsWindow - window, list - ids, list - pub_dates,
+                list - clean texts, string - normalizing rule
+        OUTPUT: int - articles added (older ones than the window are not)
         '''
-        #TODO
-        pass
+        dates = dict(zip(ids, pub_dates))
+        ids, weights, _ = _score_batch(ids, texts, self.vectorizer, self.H,
+                                       normalize)
+        return sum(window.add(i, dates[i], w) for i, w in zip(ids, weights))
 
     def empire_plot_counts(self, table, start_date='2001-10',
-                           end_date='2014-11', verbose=False, **kwargs):
+                           end_date='2014-11', verbose=False,
+                           single_pass=False, store=None, **kwargs):
         '''
         Gets topic frequencies for every month in range. Output designed
-            to build a stacked area chart.
+            to build a stacked area chart. single_pass scores the whole
+            date span at once and buckets articles by month, instead of
+            running topic_count_by_date_range once per month; store is an
+            optional FeatureStore for the single pass to read from. With a
+            TopicCube in kwargs every month is read from the cube, which
+            needs no scoring, so single_pass makes no difference.
 
         INPUT:  mongo-collection - table, string - start_date,
-                string - end_date, bool - verbose,
-                **kwargs for topic_freq_by_date_range
+                string - end_date, bool - verbose, bool - single_pass,
+                FeatureStore - store,
+                **kwargs for topic_count_by_date_range
         OUTPUT: dict - freq_table of topic counts keyed by year-month
         '''
         # build date list
@@ -109,6 +332,13 @@ class TopicAnalyzer(object):
         while dates[-1] != _next_month(end_date):
             dates.append(_next_month(dates[-1]))
         freq_table = {d: [0] * self.num_topics for d in dates}
+        if single_pass and kwargs.get('cube') is None:
+            X, pub_dates, lengths = self._date_span_features(table, dates[0],
+                                                             dates[-1], store)
+            counts = _monthly_topic_counts(X, self.H, lengths, pub_dates,
+                                           dates[:-1], **kwargs)
+            freq_table.update(zip(dates[:-1], counts))
+            return freq_table
         for d in range(len(dates) - 1):
             if verbose:
                 print 'getting frequencies for ', dates[d]
@@ -116,6 +346,29 @@ class TopicAnalyzer(object):
                     dates[d], dates[d+1], **kwargs)
         return freq_table
 
+    def _date_span_features(self, table, start_date, end_date, store=None):
+        '''
+        Vectorizes every article published from start_date up to (not
+            including) the end_date month, or loads them from store.
+
+        INPUT:  mongo-collection - table, string - start_date,
+                string - end_date, FeatureStore - store
+        OUTPUT: 2d sparse array - X, np array - pub_dates,
+                n x 1 np array - article lengths
+        '''
+        if store is not None:
+            store.check(self.vectorizer, lengths=True)
+            start, stop = store.date_slice(start_date, end_date)
+            X, _, lengths = store.rows(start, stop)
+            return X, np.asarray(store.pub_dates[start:stop]), lengths
+        q = {'pub_date': {'$gte': start_date, '$lt': end_date},
+             'clean_text': {'$exists': True, '$ne': ''}}
+        cursor = table.find(q, {'clean_text': 1, 'pub_date': 1})
+        docs = [(c['pub_date'], c['clean_text']) for c in cursor]
+        texts = [d[1] for d in docs]
+        X = self.vectorizer.transform(texts)
+        return X, np.array([d[0] for d in docs]), _get_article_lengths(texts)
+
     def bake_empire_csv(self, freq_table, csv_file, topic_names=None):
         '''
         Creates a CSV from the empire_plot_counts output. Easy to plug
@@ -129,7 +382,9 @@ class TopicAnalyzer(object):
         df.to_csv(open(csv_file, 'w'), index_label='date')
 
     def store_topic_weights(self, table, model_name, normalize='linear',
-                            min_doc_length=None, verbose=False):
+                            min_doc_length=None, verbose=False,
+                            batch_size=None, n_jobs=None, cache_dir=None,
+                            top_k=None, weight_floor=0., cube=None):
         '''
         Calculates topic weights for each record in the table, storing them
             back into the record for easy future access. Normalize takes
@@ -137,14 +392,35 @@ class TopicAnalyzer(object):
                 'linear' - divide by word count
                 'sqrt' - divide by sqrt of word count
                 'none' - don't normalize
+        Set batch_size to score batches of records with one transform and
+            one bulk_write each; n_jobs additionally scores the batches
+            in a process pool (-1 for one per core). cache_dir also
+            appends the new weights to the model's columnar cache
+            (see feature_store.TopicWeightStore).
+        Set top_k to store only each article's top_k topics with weights
+            above weight_floor, in the compact binary form of
+            feature_store.encode_topic_weights, instead of a dense list;
+            the readers in this module decode either form.
+        Pass a TopicCube (see build_cube) to add the newly scored
+            articles to it as well; it must not already hold them.
 
         INPUT:  mongo-collection - table, string - model_name,
-                string - normalizing rule, boolean - verbose
+                string - normalizing rule, int - min_doc_length,
+                boolean - verbose, int - batch_size, int - n_jobs,
+                string - cache_dir, int - top_k, float - weight_floor,
+                TopicCube - cube
         OUTPUT: None
         '''
         query = {'clean_text': {'$exists': True, '$ne': ''},
                  model_name: {'$exists': False}}
-        cursor = table.find(query)
+        if batch_size or n_jobs or cache_dir or top_k or cube is not None:
+            self._store_topic_weights_batched(table, model_name, query,
+                                              normalize, min_doc_length,
+                                              batch_size or 1000, n_jobs,
+                                              verbose, cache_dir, top_k,
+                                              weight_floor, cube)
+            return
+        cursor = table.find(query, {'clean_text': 1})
         i = 0
         for record in cursor:
             if verbose:
@@ -169,10 +445,282 @@ class TopicAnalyzer(object):
             table.update({'_id': record['_id']},
                          {'$set': {model_name: list(dtf[0])}})
 
+    def _store_topic_weights_batched(self, table, model_name, query,
+                                     normalize, min_doc_length, batch_size,
+                                     n_jobs=None, verbose=False,
+                                     cache_dir=None, top_k=None,
+                                     weight_floor=0., cube=None):
+        '''
+        Batched store_topic_weights: reads the cursor in chunks, scores each
+            chunk with _score_batch and writes it with one bulk_write. With
+            n_jobs, chunks are scored in a process pool, keeping at most
+            two chunks per worker in flight. With top_k, weights are
+            stored (and cached) sparse; cube gets the full weights.
+
+        INPUT:  mongo-collection - table, string - model_name,
+                dict - mongo query, string - normalizing rule,
+                int - min_doc_length, int - batch_size, int - n_jobs,
+                boolean - verbose, string - cache_dir, int - top_k,
+                float - weight_floor, TopicCube - cube
+        OUTPUT: None
+        '''
+        scorer = (self.vectorizer, self.H, normalize, min_doc_length)
+        cursor = table.find(query, {'clean_text': 1, 'pub_date': 1,
+                                    'type_of_material': 1})
+        records = batches(cursor, batch_size)
+        if cache_dir is not None or cube is not None:
+            metas = deque()
+            records = _remember_meta(records, metas)
+        chunks = (([r['_id'] for r in b], [r['clean_text'] for r in b])
+                  for b in records)
+        n = 0
+
+        def write(result):
+            ids, weights, lengths = result
+            if cache_dir is not None or cube is not None:
+                # results come back in chunk order; short texts were dropped
+                meta = metas.popleft()
+                meta = [meta[i] for i in ids]
+            if cube is not None and ids:
+                cube.add([m[0] for m in meta],
+                         weights * _length_norms(lengths, normalize),
+                         lengths)
+            if top_k and ids:
+                values = encode_topic_weights(weights, top_k, weight_floor)
+                weights = decode_topic_weights(values)  # what readers see
+            else:
+                values = weights.tolist()
+            if ids:
+                table.bulk_write([UpdateOne({'_id': i},
+                                            {'$set': {model_name: w}})
+                                  for i, w in zip(ids, values)],
+                                 ordered=False)
+            if cache_dir is not None:
+                cached.append((ids, meta, weights))
+            return len(ids)
+
+        cached = []
+        if not n_jobs:
+            for ids, texts in chunks:
+                n += write(_score_batch(ids, texts, *scorer))
+                if verbose:
+                    print 'updated topics for ', n, ' records'
+        else:
+            n += self._score_in_pool(chunks, scorer, n_jobs, write, verbose)
+        if cache_dir is not None and cached:
+            rows = [r for c in cached for r in c[1]]
+            save_topic_weights(cache_dir, model_name,
+                               [i for c in cached for i in c[0]],
+                               [r[0] for r in rows],
+                               np.vstack([c[2] for c in cached]),
+                               [r[1] for r in rows])
+
+    def _score_in_pool(self, chunks, scorer, n_jobs, write, verbose=False):
+        '''
+        Scores chunks of (ids, texts) in a process pool, passing each
+            result to write in order. At most two chunks per worker are
+            in flight.
+
+        INPUT:  iterable - chunks, tuple - _score_batch model arguments,
+                int - n_jobs, function - write, boolean - verbose
+        OUTPUT: int - records written
+        '''
+        n = 0
+
+        if n_jobs < 0:
+            n_jobs = cpu_count()
+        if self._artifacts is not None:
+            # workers map the saved model instead of unpickling a copy
+            scorer = (None, None) + tuple(scorer[2:]) + (self._artifacts,)
+        pool = Pool(n_jobs, initializer=_init_scorer, initargs=scorer)
+        pending = deque()
+        try:
+            for ids, texts in chunks:
+                pending.append(pool.apply_async(_pooled_score_batch,
+                                                (ids, texts)))
+                if len(pending) >= 2 * n_jobs:
+                    n += write(pending.popleft().get())
+                    if verbose:
+                        print 'updated topics for ', n, ' records'
+            while pending:
+                n += write(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+        return n
+
+
+class CurrentEventsWindow(object):
+    '''
+    Rolling window of the last n_days of scored articles, for spotting
+        current events. Articles are totaled into per-day buckets (summed
+        topic weights and the strongest article per topic), so adding one
+        takes a few vector operations no matter how full the window is,
+        and whole days age out as newer articles arrive. A topic is
+        flagged when its share of the window's topic weight is at least
+        spike_ratio times its baseline share.
+
+    INPUT:  np array - baseline topic weight totals (or shares),
+            int - n_days, float - spike_ratio, int - min_articles (needed
+            in the window before anything is flagged)
+    '''
+    def __init__(self, baseline, n_days=7, spike_ratio=2., min_articles=3):
+        baseline = np.asarray(baseline, dtype=float)
+        if not baseline.sum() > 0:
+            raise ValueError('baseline has no topic weight')
+        self.baseline = baseline / baseline.sum()
+        self.n_days = n_days
+        self.spike_ratio = spike_ratio
+        self.min_articles = min_articles
+        self.today = None
+        self._days = {}
+
+    def __len__(self):
+        return sum(b['n'] for b in self._days.itervalues())
+
+    def add(self, article_id, pub_date, weights):
+        '''
+        Adds one scored article, moving the window forward if it is the
+            newest yet. Articles older than the window are skipped.
+
+        INPUT:  article_id, string - pub_date, np array - topic weights
+        OUTPUT: bool - whether the article was added
+        '''
+        day = _day_number(pub_date)
+        if self.today is None or day > self.today:
+            self.today = day
+            for old in [d for d in self._days if d <= day - self.n_days]:
+                del self._days[old]
+        elif day <= self.today - self.n_days:
+            return False
+        bucket = self._days.get(day)
+        if bucket is None:
+            num_topics = len(self.baseline)
+            bucket = self._days[day] = {
+                'n': 0, 'totals': np.zeros(num_topics),
+                'best': np.zeros(num_topics),
+                'best_ids': np.empty(num_topics, dtype=object)}
+        weights = np.asarray(weights, dtype=float)
+        bucket['n'] += 1
+        bucket['totals'] += weights
+        better = weights > bucket['best']
+        bucket['best'][better] = weights[better]
+        bucket['best_ids'][better] = article_id
+        return True
+
+    def shares(self):
+        '''
+        Each topic's share of the topic weight in the window.
+
+        OUTPUT: np array - shares (sum to 1, or all 0 if empty)
+        '''
+        totals = np.zeros(len(self.baseline))
+        for bucket in self._days.itervalues():
+            totals += bucket['totals']
+        return totals / totals.sum() if totals.sum() > 0 else totals
+
+    def flagged(self):
+        '''
+        Lists the topics running spike_ratio times above their baseline
+            share, most above first, with the window's strongest article
+            for each.
+
+        OUTPUT: list - (topic index, window share, baseline share,
+                best article _id) tuples
+        '''
+        if not self._days or len(self) < self.min_articles:
+            return []
+        shares = self.shares()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = shares / self.baseline
+        hot = np.flatnonzero(ratios >= self.spike_ratio)
+        hot = hot[np.argsort(-ratios[hot], kind='mergesort')]
+        buckets = self._days.values()
+        strongest = np.vstack([b['best'] for b in buckets]).argmax(axis=0)
+        return [(t, shares[t], self.baseline[t],
+                 buckets[strongest[t]]['best_ids'][t]) for t in hot]
+
+
+def _remember_meta(record_batches, metas):
+    '''
+    Passes batches of records through, appending each batch's
+        (pub_date, type_of_material) pairs keyed by _id to metas for the
+        topic weight cache.
+    '''
+    for batch in record_batches:
+        metas.append(dict((r['_id'], (r.get('pub_date', ''),
+                                      r.get('type_of_material', '')))
+                          for r in batch))
+        yield batch
+
+
+def _score_batch(ids, texts, vectorizer, H, normalize='linear',
+                 min_doc_length=None):
+    '''
+    Scores a batch of clean texts with one transform and one sparse-dense
+        product, normalizing by word count like store_topic_weights.
+        Texts shorter than min_doc_length are dropped.
+
+    INPUT:  list - ids, list - clean texts, vectorizer object - vectorizer,
+            2d numpy array - H, string - normalizing rule,
+            int - min_doc_length
+    OUTPUT: list - ids kept, 2d np array - topic weights (kept x topics),
+            n x 1 np array - word counts (kept)
+    '''
+    L = np.array([len(t.split()) for t in texts], dtype=float)
+    if min_doc_length is not None:
+        keep = np.flatnonzero(L >= min_doc_length)
+        ids = [ids[i] for i in keep]
+        texts = [texts[i] for i in keep]
+        L = L[keep]
+    L = L[:, np.newaxis]
+    if not ids:
+        return [], np.zeros((0, H.shape[0])), L
+    dtf = vectorizer.transform(texts).dot(H.T) / _length_norms(L, normalize)
+    return ids, dtf, L
+
+
+def _length_norms(lengths, normalize='linear'):
+    '''
+    What store_topic_weights' normalizing rule divides each article's
+        weights by.
+
+    INPUT:  n x 1 np array - word counts, string - normalizing rule
+    OUTPUT: n x 1 np array - divisors
+    '''
+    if normalize == 'linear':
+        return lengths
+    if normalize == 'sqrt':
+        return np.sqrt(lengths)
+    return np.ones_like(lengths)
+
+
+_SCORER = None
+
+
+def _init_scorer(vectorizer, H, normalize, min_doc_length, artifacts=None):
+    '''
+    Process pool initializer: keeps the model in each worker so batches
+        don't have to ship it. With artifacts, each worker loads the model
+        from that save_model_artifacts directory instead.
+    '''
+    global _SCORER
+    if artifacts is not None:
+        vectorizer = load_vectorizer(artifacts)
+        H = load_topic_matrix(artifacts)
+    _SCORER = (vectorizer, H, normalize, min_doc_length)
+
+
+def _pooled_score_batch(ids, texts):
+    '''
+    Process pool worker: _score_batch with the worker's model.
+    '''
+    return _score_batch(ids, texts, *_SCORER)
+
 
 def smooth_time_series(table, model_name, topic_names, output_csv,
                        ranked=True, rank_number=3, topic_threshold=.001,
-                       month_interval=3, normalize=False):
+                       month_interval=3, normalize=False, cache_dir=None):
     '''
     Time-series topic analysis; counts articles per topic-month which either:
             1) are in the n highest-ranked topics for an article
@@ -182,97 +730,188 @@ def smooth_time_series(table, model_name, topic_names, output_csv,
         trends over time.
     Normalize divides each time-series by the total number of articles per
         month to get relative frequency rather than count.
+    cache_dir reads the weights from the model's columnar cache instead
+        of mongo.
 
     INPUT:  mongo-collection - table, string - model_name, list - topic_names,
             string - output_csv, bool - ranked, int - rank_number,
-            float - topic_threshold, int - month_interval, bool - normalize
+            float - topic_threshold, int - month_interval, bool - normalize,
+            string - cache_dir
     OUTPUT: None
     '''
     startmonth = 10 - month_interval
-    query = {model_name: {'$exists':True},
-             'pub_date': {'$gt': '2001-0' + str(startmonth)},
-             'type_of_material':'News'}
-    n = table.find(query).count()
-    num_topics = len(table.find_one(query)[model_name])
-    cursor = table.find(query)
-
-    ids = [None] * n
-    pubdates = [None] * n
-    weights = np.zeros((n, num_topics))
-    for i, record in enumerate(cursor):
-        ids[i] = record['_id']
-        pubdates[i] = record['pub_date'][:10]
-        weights[i] = record[model_name]
+    ids, pubdates, weights = _load_topic_weights(table, model_name,
+            {'$gt': '2001-0' + str(startmonth)}, cache_dir)
+    outputdf = topic_time_series(pubdates, weights, ranked, rank_number,
+                                 topic_threshold, month_interval, normalize)
+    outputdf.columns = topic_names
+    outputdf.to_csv(output_csv, index_label='date')
+
+
+def topic_time_series(pub_dates, weights, ranked=True, rank_number=3,
+                      topic_threshold=.001, month_interval=3,
+                      normalize=False):
+    '''
+    Builds the smoothed topic-month table behind smooth_time_series for
+        all topics at once: the matching (article, topic) pairs are
+        counted per month with one bincount, and the rolling mean of
+        month_interval months is a difference of cumulative sums along
+        the month axis. Months run from the first article to the last;
+        months without articles count as zero. Each row is dated
+        2 * month_interval weeks before its month end, and the first
+        month_interval - 1 rows (incomplete windows) are 0.
+    Ranked picks with zero weight are not counted, so articles stored
+        sparse with fewer than rank_number topics (see
+        store_topic_weights' top_k) count only the topics they have.
+
+    INPUT:  list - pub_dates, 2d np array - weights (articles x topics),
+            bool - ranked, int - rank_number, float - topic_threshold,
+            int - month_interval, bool - normalize
+    OUTPUT: DataFrame - smoothed counts or frequencies (months x topics)
+    '''
+    weights = np.asarray(weights)
+    num_topics = weights.shape[1]
+    if len(pub_dates) == 0:
+        return pd.DataFrame(np.zeros((0, num_topics)),
+                            index=pd.DatetimeIndex([]))
+    codes = np.array([int(d[:4]) * 12 + int(d[5:7]) - 1 for d in pub_dates])
+    first = codes.min()
+    n_months = codes.max() - first + 1
+    month_idx = codes - first
 
     if ranked:
-        tops = np.argsort(weights, axis=1)[:,-rank_number:]
-        bw = np.zeros(weights.shape)
-        for i, row in enumerate(tops):
-            for j in row:
-                bw[i, j] = 1
-        bdf = pd.DataFrame(bw, index=pd.DatetimeIndex(pubdates))
+        k = min(rank_number, num_topics)
+        tops = np.argpartition(weights, -k, axis=1)[:, -k:]
+        rows, cols = np.repeat(np.arange(len(weights)), k), tops.ravel()
+        # zero-weight picks are just arbitrary columns of a sparse row
+        keep = weights[rows, cols] > 0
+        rows, cols = rows[keep], cols[keep]
     else:
-        bdf = pd.DataFrame(weights > topic_threshold,
-                           index=pd.DatetimeIndex(pubdates))
+        rows, cols = np.nonzero(weights > topic_threshold)
+    counts = np.bincount(month_idx[rows] * num_topics + cols,
+                         minlength=n_months * num_topics)
+    smoothed = _rolling_mean(counts.reshape(n_months, num_topics),
+                             month_interval)
+    if normalize:
+        # relative to the rolling mean of articles per month
+        articles = np.bincount(month_idx, minlength=n_months)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            smoothed /= _rolling_mean(articles[:, np.newaxis], month_interval)
 
-    bts = [None] * num_topics
-    offset = pd.offsets.Week(month_interval * 2)
+    month_ends = pd.date_range('%d-%02d-01' % (first // 12, first % 12 + 1),
+                               periods=n_months, freq='M')
+    index = month_ends - pd.offsets.Week(month_interval * 2)
+    return pd.DataFrame(smoothed, index=index).fillna(0)
 
-    if normalize:
-        # determine articles per month for scaling
-        all_articles_ts = pd.TimeSeries(1, pd.DatetimeIndex(sorted(pubdates)))
-        abm = pd.rolling_mean(all_articles_ts.resample('M', how='count'),
-                              month_interval)
-        for i in range(num_topics):
-            bts[i] = pd.rolling_mean(pd.TimeSeries(data=bdf[i],
-                    index=bdf.index).resample('M', how='sum'),
-                    month_interval) / abm
-            bts[i].index = bts[i].index - offset
-    else:
-        for i in range(num_topics):
-            bts[i] = pd.rolling_mean(pd.TimeSeries(data=bdf[i],
-                    index=bdf.index).resample('M', how='sum'),
-                    month_interval)
-            bts[i].index = bts[i].index - offset
 
-    outputdf = pd.concat([s for s in bts], axis=1).fillna(0)
-    outputdf.columns = topic_names
-    outputdf.to_csv(output_csv, index_label='date')
+def _rolling_mean(counts, window):
+    '''
+    Mean of each window of rows ending at each row, NaN where the window
+        is incomplete (like pandas' rolling mean).
+
+    INPUT:  2d np array - counts (rows x columns), int - window
+    OUTPUT: 2d np array - means
+    '''
+    means = np.full(counts.shape, np.nan)
+    if window <= len(counts):
+        totals = np.cumsum(np.vstack([np.zeros((1, counts.shape[1]),
+                                               dtype=counts.dtype),
+                                      counts]), axis=0)
+        means[window - 1:] = (totals[window:] - totals[:-window]) / \
+            float(window)
+    return means
 
 
 def get_best_articles_overall(table, model_name, topic_names,
                               start_date='2001-09', end_date='2014-11',
-                              top_count=25):
+                              top_count=25, cache_dir=None, chunk_size=None):
     '''
     Finds the highest-weighed articles for each topic using a specified
-        model. Returns a dict for further processing.
+        model. Returns a dict for further processing. cache_dir reads the
+        weights from the model's columnar cache instead of mongo. Set
+        chunk_size to stream the weights in chunks through
+        streaming_top_k rather than loading them all at once.
 
     INPUT:  mongo-collection - table, string - model_name,
             list - topic_names, string - start_date, string - end_date,
-            int - top_count
+            int - top_count, string - cache_dir, int - chunk_size
     OUTPUT: dict - lists of article ids keyed by topic
     '''
-    query = {model_name: {'$exists':True}, 'type_of_material':'News',
-             'pub_date': {'$gt': start_date, '$lt': end_date}}
-    num_topics = len(topic_names)
-    N = table.find(query).count()
+    date_query = {'$gt': start_date, '$lt': end_date}
+    if chunk_size:
+        chunks = _iter_topic_weights(table, model_name, date_query,
+                                     cache_dir, chunk_size)
+        best_ids, _ = streaming_top_k(chunks, top_count, len(topic_names))
+        return {topic: best_ids[:, i] for i, topic in enumerate(topic_names)}
 
-    bests = {}
-    article_ids = [None] * N
-    article_weights = np.zeros((N, num_topics))
-    cursor = table.find(query)
-    for i, record in enumerate(cursor):
-        article_ids[i] = record['_id']
-        article_weights[i] = record[model_name]
-    article_ids = np.array(article_ids)
+    article_ids, _, article_weights = _load_topic_weights(table, model_name,
+            date_query, cache_dir)
+    tops = top_k_indices(article_weights, top_count)
 
+    bests = {}
     for i, topic in enumerate(topic_names):
-        best_ids = np.argsort(article_weights[:, i])[:-1-top_count:-1]
-        bests[topic] = article_ids[best_ids]
+        bests[topic] = article_ids[tops[:, i]]
 
     return bests
 
 
+def top_k_indices(weights, k):
+    '''
+    Finds the row indexes of the k largest values in each column (or in a
+        1d array), best first. np.argpartition makes this O(n) per column
+        plus a sort of just the k winners.
+
+    INPUT:  1d or 2d numpy array - weights, int - k
+    OUTPUT: np array - indexes (k, or k x columns); fewer than k rows if
+            weights has fewer rows
+    '''
+    weights = np.asarray(weights)
+    k = min(k, weights.shape[0])
+    if k == 0:
+        return np.zeros((0,) + weights.shape[1:], dtype=int)
+    top = np.argpartition(-weights, k - 1, axis=0)[:k]
+    if weights.ndim == 1:
+        return top[np.argsort(-weights[top], kind='mergesort')]
+    cols = np.arange(weights.shape[1])
+    rank = np.argsort(-weights[top, cols], axis=0, kind='mergesort')
+    return top[rank, cols]
+
+
+def streaming_top_k(chunks, k, num_topics=0):
+    '''
+    Finds the k highest-weighted ids per topic from a stream of
+        (ids, weights) chunks, such as _iter_topic_weights over a cursor
+        or memmap. Keeps a bounded k x topics buffer which is merged with
+        each chunk through top_k_indices, so memory depends on the chunk
+        size and cost stays O(n) per topic. num_topics sets the width
+        when there are no chunks.
+
+    INPUT:  iterable - (np array ids, 2d np array weights) chunks, int - k,
+            int - num_topics
+    OUTPUT: 2d np array - ids (k x topics), 2d np array - weights
+            (k x topics), best first
+    '''
+    best_ids, best_w = None, None
+    for ids, weights in chunks:
+        ids, weights = np.asarray(ids), np.asarray(weights)
+        if best_w is None:
+            best_ids = np.zeros((0, weights.shape[1]), dtype=ids.dtype)
+            best_w = np.zeros((0, weights.shape[1]), dtype=weights.dtype)
+        n_best = best_w.shape[0]
+        candidates = np.vstack([best_w, weights])
+        top = top_k_indices(candidates, k)
+        cols = np.arange(candidates.shape[1])
+        # rows below n_best point into the buffer, the rest into the chunk
+        new_ids = ids[np.maximum(top - n_best, 0)].astype(
+            np.result_type(ids, best_ids))
+        kept = top < n_best
+        new_ids[kept] = best_ids[top[kept], np.nonzero(kept)[1]]
+        best_ids, best_w = new_ids, candidates[top, cols]
+    if best_w is None:
+        return np.zeros((0, num_topics)), np.zeros((0, num_topics))
+    return best_ids, best_w
+
+
 def compile_overall_best_article_json(table, model_name, best_articles,
                                       topic_names, outputfile):
     '''
@@ -286,9 +925,12 @@ def compile_overall_best_article_json(table, model_name, best_articles,
     '''
     num_topics = len(topic_names)
     topic_dict = {name:[] for name in topic_names}
+    records = records_by_id(table,
+                            [a for L in best_articles.values() for a in L],
+                            ARTICLE_FIELDS)
     for topic, articles in best_articles.iteritems():
         for i, a in enumerate(articles):
-            record = table.find_one({'_id': a})
+            record = records[a]
             d = {'pub_date': record['pub_date'][:10],
                  'lead_paragraph': record['lead_paragraph'],
                  'headline': record['headline'],
@@ -298,37 +940,147 @@ def compile_overall_best_article_json(table, model_name, best_articles,
     json.dump(topic_dict, open(outputfile, 'w'))
 
 
+def detect_spikes(series, window=12, z_threshold=3., min_value=0.):
+    '''
+    Finds spikes in every column of a time-series matrix at once with a
+        rolling z-score: each row is compared with the mean and standard
+        deviation of the window rows before it, from cumulative sums of
+        the values and their squares. Rows at least z_threshold above
+        (and worth more than min_value) are flagged, and runs of flagged
+        rows merge into one spike. The first window rows are never
+        flagged.
+
+    INPUT:  2d np array - series (months x topics), int - window,
+            float - z_threshold, float - min_value
+    OUTPUT: list - (topic index, first row, last row, peak row) tuples,
+            by topic then row
+    '''
+    x = np.asarray(series, dtype=float)
+    n_rows, num_topics = x.shape
+    z = np.full(x.shape, np.nan)
+    if n_rows > window:
+        zero = np.zeros((1, num_topics))
+        sums = np.cumsum(np.vstack([zero, x]), axis=0)
+        squares = np.cumsum(np.vstack([zero, x ** 2]), axis=0)
+        mean = (sums[window:-1] - sums[:-window - 1]) / window
+        var = (squares[window:-1] - squares[:-window - 1]) / window - mean ** 2
+        std = np.sqrt(np.maximum(var, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # a rise after a flat history is an infinitely large z-score
+            z[window:] = (x[window:] - mean) / std
+    with np.errstate(invalid='ignore'):
+        flags = (z >= z_threshold) & (x > min_value)
+    edges = np.diff(np.vstack([np.zeros((1, num_topics), dtype=int),
+                               flags.astype(int),
+                               np.zeros((1, num_topics), dtype=int)]),
+                    axis=0)
+    topics, starts = np.nonzero(edges.T == 1)
+    stops = np.nonzero(edges.T == -1)[1]
+    return [(t, a, b - 1, a + np.argmax(x[a:b, t]))
+            for t, a, b in zip(topics, starts, stops)]
+
+
+def get_spike_articles(table, model_name, topic_names, top_k=5, window=12,
+                       z_threshold=3., min_value=0., month_interval=3,
+                       cache_dir=None, **kwargs):
+    '''
+    Finds where each topic spikes in the smoothed monthly series that
+        smooth_time_series plots (see detect_spikes) and the top_k
+        highest-weighted articles from each spike. A spike's articles
+        come from its months plus the month_interval - 1 months before,
+        which the rolling mean spreads into it. Returns a dict for
+        compile_spike_article_json. cache_dir reads the weights from the
+        model's columnar cache instead of mongo.
+
+    INPUT:  mongo-collection - table, string - model_name,
+            list - topic_names, int - top_k, int - window,
+            float - z_threshold, float - min_value, int - month_interval,
+            string - cache_dir, **kwargs for topic_time_series
+    OUTPUT: dict - lists of (peak month, article id) keyed by topic
+    '''
+    startmonth = 10 - month_interval
+    ids, pub_dates, weights = _load_topic_weights(table, model_name,
+            {'$gt': '2001-0' + str(startmonth)}, cache_dir)
+    series = topic_time_series(pub_dates, weights,
+                               month_interval=month_interval, **kwargs)
+    month_ends = series.index + pd.offsets.Week(month_interval * 2)
+    months = [d.strftime('%Y-%m') for d in month_ends]
+
+    # articles grouped by month, so a spike's articles are one slice
+    month_idx = _month_index(pub_dates, months)
+    order = np.argsort(month_idx, kind='mergesort')
+    bounds = np.searchsorted(month_idx[order], np.arange(len(months) + 1))
+
+    spikes = {name: [] for name in topic_names}
+    for t, first, last, peak in detect_spikes(series.values, window,
+                                              z_threshold, min_value):
+        rows = order[bounds[max(first - month_interval + 1, 0)]:
+                     bounds[last + 1]]
+        rows = rows[weights[rows, t] > 0]
+        seen = set(a for _, a in spikes[topic_names[t]])
+        for r in rows[top_k_indices(weights[rows, t], top_k)]:
+            if ids[r] not in seen:
+                seen.add(ids[r])
+                spikes[topic_names[t]].append((months[peak], ids[r]))
+    return spikes
+
+
+def compile_spike_article_json(table, spike_articles, outputfile):
+    '''
+    Takes the spike_articles dict from get_spike_articles, gets extra
+        article information from the table with one batched query, and
+        creates a JSON file in the D3 front-end's tooltip article format
+        (plus the month each article's spike peaked).
+
+    INPUT:  mongo-collection - table, dict - spike_articles,
+            string - outputfile
+    OUTPUT: None
+    '''
+    records = records_by_id(table,
+                            [a for L in spike_articles.values() for _, a in L],
+                            ARTICLE_FIELDS)
+    topic_dict = {}
+    for topic, articles in spike_articles.iteritems():
+        topic_dict[topic] = [{'pub_date': records[a]['pub_date'][:10],
+                              'lead_paragraph': records[a]['lead_paragraph'],
+                              'headline': records[a]['headline'],
+                              'web_url': records[a]['web_url'],
+                              'spike': month}
+                             for month, a in articles]
+
+    with open(outputfile, 'w') as f:
+        json.dump(topic_dict, f)
+
+
 def get_best_articles_per_month(table, model_name, start_date='2001-09',
-                                end_date='2014-11', verbose=False):
+                                end_date='2014-11', verbose=False,
+                                cache_dir=None, top_k=1):
     '''
     Finds the highest-weighed article every month for each topic,
         using a specified model. Returns a dict for further processing.
+        cache_dir reads the weights from the model's columnar cache
+        instead of mongo. With top_k > 1, each topic gets a list of its
+        top_k (id, weight) tuples per month instead of a single tuple.
 
     INPUT:  mongo-collection - table, string - model_name,
-            string - start_date, string - end_date, bool - verbose
+            string - start_date, string - end_date, bool - verbose,
+            string - cache_dir, int - top_k
     OUTPUT: dict - best_articles keyed by month
     '''
-    query = {model_name: {'$exists':True}, 'type_of_material':'News'}
-    num_topics = len(table.find_one(query)[model_name])
-
     dates = [start_date]
     while dates[-1] != _next_month(end_date):
         dates.append(_next_month(dates[-1]))
-    best_articles = {}
-    for d in range(len(dates) - 1):
-        if verbose:
-            print 'selecting best articles for ', dates[d]
-        best_this_month = [(None, 0.0)] * num_topics
-        query['pub_date'] = {'$gte': dates[d], '$lt': dates[d + 1]}
-        cursor = table.find(query)
-        for record in cursor:
-            w = record[model_name]
-            for i, v in enumerate(w):
-                if v > best_this_month[i][1]:
-                    best_this_month[i] = (record['_id'], v)
-        best_articles[dates[d]] = best_this_month
-
-    return best_articles
+    months = dates[:-1]
+    ids, pub_dates, weights = _load_topic_weights(table, model_name,
+            {'$gte': dates[0], '$lt': dates[-1]}, cache_dir)
+    if verbose:
+        print 'selecting best articles from ', len(ids), ' articles'
+    month_idx = _month_index(pub_dates, months)
+    if top_k == 1:
+        bests = _best_per_group(ids, weights, month_idx, len(months))
+    else:
+        bests = _top_k_per_group(ids, weights, month_idx, len(months), top_k)
+    return dict(zip(months, bests))
 
 
 def compile_best_article_json(table, model_name, best_articles, topic_list,
@@ -344,16 +1096,22 @@ def compile_best_article_json(table, model_name, best_articles, topic_list,
     '''
     num_topics = len(topic_list)
     topic_dict = {i:[] for i in range(num_topics)}
+    records = records_by_id(table,
+                            [t[0] for L in best_articles.values() for t in L],
+                            ARTICLE_FIELDS + [model_name])
     for month, topics in best_articles.iteritems():
         for i, t in enumerate(topics):
-            record = table.find_one({'_id': t[0]})
+            if t[0] is None:  # no article for this topic this month
+                continue
+            record = records[t[0]]
             d = {'pub_date': record['pub_date'][:10],
                  'lead_paragraph': record['lead_paragraph'],
                  'headline': record['headline'],
                  'web_url': record['web_url'],
                  'weight': t[1],
                  '_id': t[0],
-                 'weights_sum': sum(record[model_name])}
+                 'weights_sum': decode_topic_weights(
+                     [record[model_name]]).sum()}
             topic_dict[i].append(d)
     for i, t in enumerate(topic_list):
         topic_dict[t] = topic_dict.pop(i)
@@ -383,6 +1141,201 @@ def filter_best_article_json(filename=None, jsond=None, threshold=.001):
     return filtered_baj
 
 
+def _monthly_topic_counts(X, H, lengths, pub_dates, months,
+                          doc_topic_threshold=.1, only_best_match=True):
+    '''
+    Counts matching articles per topic for every month in one pass: one
+        sparse product for all articles, then a bincount over
+        (month, topic) cells. Same counts as topic_count_by_date_range
+        run on each month.
+
+    INPUT:  2d sparse array - X, 2d numpy array - H,
+            n x 1 np array - article lengths, list - pub_dates,
+            list - months ('YYYY-MM', sorted), float - doc_topic_threshold,
+            bool - only_best_match
+    OUTPUT: 2d np array - counts (months x topics)
+    '''
+    num_topics = H.shape[0]
+    month_idx = _month_index(pub_dates, months)
+    keep = month_idx >= 0
+    doc_topic_freqs = X[np.flatnonzero(keep)].dot(H.T) / lengths[keep]
+    month_idx = month_idx[keep]
+    if only_best_match:
+        cells = month_idx * num_topics + doc_topic_freqs.argmax(axis=1)
+        counts = np.bincount(cells, minlength=len(months) * num_topics)
+        return counts.reshape(len(months), num_topics)
+    matches = doc_topic_freqs > doc_topic_threshold
+    return _group_sum(matches.astype(int), month_idx, len(months))
+
+
+def _month_index(pub_dates, months):
+    '''
+    Finds the position of each article's month in a sorted list of
+        year-month strings; -1 for articles outside those months.
+
+    INPUT:  list - pub_dates, list - months ('YYYY-MM', sorted)
+    OUTPUT: np array - month index per article
+    '''
+    article_months = np.array([d[:7] for d in pub_dates], dtype=unicode)
+    months = np.array(months, dtype=unicode)
+    idx = np.searchsorted(months, article_months)
+    found = idx < len(months)
+    found[found] = months[idx[found]] == article_months[found]
+    return np.where(found, idx, -1)
+
+
+def _group_sum(values, groups, n_groups):
+    '''
+    Sums the rows of values that share a group index, with
+        np.add.reduceat over the rows sorted by group.
+
+    INPUT:  2d np array - values, np array - group index per row,
+            int - n_groups
+    OUTPUT: 2d np array - sums (n_groups x columns)
+    '''
+    sums = np.zeros((n_groups, values.shape[1]), dtype=values.dtype)
+    if len(groups) == 0:
+        return sums
+    order = np.argsort(groups, kind='mergesort')
+    groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sums[groups[starts]] = np.add.reduceat(values[order], starts, axis=0)
+    return sums
+
+
+def _best_per_group(ids, weights, groups, n_groups):
+    '''
+    Finds the highest positive weight per topic in each group of rows with
+        segment reductions: rows are sorted by group, np.maximum.reduceat
+        gives the group maxima and np.minimum.reduceat over the row
+        numbers that reach them picks the first such row, as a scan in
+        row order would.
+
+    INPUT:  np array - ids, 2d np array - weights (rows x topics),
+            np array - group index per row (-1 to skip),
+            int - n_groups
+    OUTPUT: list - per group, a list of (id, weight) per topic
+            ((None, 0.0) when no weight is positive)
+    '''
+    num_topics = weights.shape[1]
+    output = [[(None, 0.0)] * num_topics for _ in xrange(n_groups)]
+    rows = np.flatnonzero(groups >= 0)
+    if len(rows) == 0:
+        return output
+    order = rows[np.argsort(groups[rows], kind='mergesort')]
+    g = groups[order]
+    W = np.asarray(weights[order])
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    maxes = np.maximum.reduceat(W, starts, axis=0)
+    group_of_row = np.repeat(np.arange(len(starts)),
+                             np.diff(np.r_[starts, len(g)]))
+    row_numbers = np.arange(len(g), dtype=np.int32)[:, np.newaxis]
+    candidates = np.where(W == maxes[group_of_row], row_numbers, len(g))
+    first = np.minimum.reduceat(candidates, starts, axis=0)
+    for s, group in enumerate(g[starts]):
+        output[group] = [(ids[order[r]], float(m)) if m > 0 else (None, 0.0)
+                         for r, m in zip(first[s], maxes[s])]
+    return output
+
+
+def _top_k_per_group(ids, weights, groups, n_groups, k):
+    '''
+    Like _best_per_group, but keeps the k highest positive weights per
+        topic in each group, best first.
+
+    INPUT:  np array - ids, 2d np array - weights (rows x topics),
+            np array - group index per row (-1 to skip),
+            int - n_groups, int - k
+    OUTPUT: list - per group, a list of [(id, weight), ...] per topic
+    '''
+    num_topics = weights.shape[1]
+    output = [[[] for _ in xrange(num_topics)] for _ in xrange(n_groups)]
+    rows = np.flatnonzero(groups >= 0)
+    order = rows[np.argsort(groups[rows], kind='mergesort')]
+    g = groups[order]
+    bounds = np.flatnonzero(np.r_[True, g[1:] != g[:-1], True])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        block = order[start:stop]
+        W = np.asarray(weights[block])
+        top = top_k_indices(W, k)
+        top_w = W[top, np.arange(num_topics)]
+        output[g[start]] = [[(ids[block[r]], float(w))
+                             for r, w in zip(top[:, t], top_w[:, t]) if w > 0]
+                            for t in xrange(num_topics)]
+    return output
+
+
+def _iter_topic_weights(table, model_name, date_query, cache_dir=None,
+                        chunk_size=10000):
+    '''
+    Streams the same weights as _load_topic_weights in chunks of
+        chunk_size articles.
+
+    INPUT:  mongo-collection - table, string - model_name,
+            dict - date_query, string - cache_dir, int - chunk_size
+    OUTPUT: generator - (np array ids, 2d np array weights) chunks
+    '''
+    if cache_dir is not None:
+        store = TopicWeightStore(cache_dir, model_name)
+        for chunk in store.iter_select(date_query, chunk_size=chunk_size):
+            yield chunk
+        return
+    query = {model_name: {'$exists': True}, 'type_of_material': 'News',
+             'pub_date': date_query}
+    cursor = table.find(query, {model_name: 1})
+    for batch in batches(cursor, chunk_size):
+        yield (np.array([r['_id'] for r in batch]),
+               decode_topic_weights([r[model_name] for r in batch]))
+
+
+def _load_topic_weights(table, model_name, date_query, cache_dir=None):
+    '''
+    Loads the stored topic weights of every News article whose pub_date
+        matches date_query (a mongo condition such as {'$gt': '2001-09'}),
+        from the columnar cache in cache_dir if given, else from mongo
+        with a projected cursor. Sparse stored weights come back dense.
+
+    INPUT:  mongo-collection - table, string - model_name,
+            dict - date_query, string - cache_dir
+    OUTPUT: np array - ids, np array - pub_dates,
+            2d np array - weights (articles x topics)
+    '''
+    if cache_dir is not None:
+        store = TopicWeightStore(cache_dir, model_name)
+        return store.select(date_query)
+    query = {model_name: {'$exists': True}, 'type_of_material': 'News',
+             'pub_date': date_query}
+    cursor = table.find(query, {model_name: 1, 'pub_date': 1})
+    ids, pub_dates, weights = [], [], []
+    for record in cursor:
+        ids.append(record['_id'])
+        pub_dates.append(record['pub_date'])
+        weights.append(record[model_name])
+    if not weights:
+        record = table.find_one({model_name: {'$exists': True}},
+                                {model_name: 1})
+        num_topics = (decode_topic_weights([record[model_name]]).shape[1]
+                      if record else 0)
+        return np.array(ids), np.array(pub_dates), np.zeros((0, num_topics))
+    return np.array(ids), np.array(pub_dates), decode_topic_weights(weights)
+
+
+def _topic_weight_totals(table, model_name, date_query, cache_dir=None):
+    '''
+    Sums the stored topic weights of the articles _iter_topic_weights
+        streams, one chunk at a time.
+
+    INPUT:  mongo-collection - table, string - model_name,
+            dict - date_query, string - cache_dir
+    OUTPUT: np array - total weight per topic
+    '''
+    totals = 0.
+    for _, weights in _iter_topic_weights(table, model_name, date_query,
+                                          cache_dir):
+        totals = totals + np.asarray(weights).sum(axis=0)
+    return np.atleast_1d(totals)
+
+
 def _normalize_frequencies(f):
     '''
     Normalizes and returns array f so that it sums to 1.
@@ -403,6 +1356,17 @@ def _get_article_lengths(docs):
     return L
 
 
+def _day_number(pub_date):
+    '''
+    Given a date string starting 'YYYY-MM-DD', returns its day ordinal.
+
+    INPUT:  string - pub_date
+    OUTPUT: int - proleptic Gregorian ordinal
+    '''
+    return date(int(pub_date[:4]), int(pub_date[5:7]),
+                int(pub_date[8:10])).toordinal()
+
+
 def _next_month(d):
     '''
     Given a year-month string, returns a string for the next month.
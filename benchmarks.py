@@ -0,0 +1,252 @@
+'''
+Micro-benchmarks for the Always Remember project. Each benchmark runs on
+    synthetic data (or data you pass in), so no database is needed.
+
+usage: python benchmarks.py
+'''
+import random
+import resource
+import shutil
+import tempfile
+from collections import Counter
+from datetime import date
+from multiprocessing import Pool
+from time import time
+import numpy as np
+import scipy.sparse as sp
+import nlp
+import analysis
+import feature_store
+
+
+def _timed(f, *args, **kwargs):
+    '''
+    Calls f and measures the wall-clock time it takes.
+
+    INPUT:  function - f, *args and **kwargs for f
+    OUTPUT: tuple - (result of f, float - seconds)
+    '''
+    t0 = time()
+    result = f(*args, **kwargs)
+    return result, time() - t0
+
+
+def synthetic_articles(n_docs=2000, words_per_doc=600, seed=0):
+    '''
+    Builds a corpus of messy article-like strings (mixed case, punctuation,
+        non-ascii characters, stopwords).
+
+    INPUT:  int - n_docs, int - words_per_doc, int - seed
+    OUTPUT: list - document strings
+    '''
+    rng = random.Random(seed)
+    words = (list(nlp.ALL_STOPWORDS)[:60] +
+             [u'Qaeda', u'Taliban', u'Manhattan', u'anthrax', u'9/11',
+              u'U.S.', u"Laden's", u'caf\xe9', u'--', u'"security"',
+              u'(tribunal)', u'cannot', u'gonna', u'Pentagon,', u'war.'])
+    return [u' '.join(rng.choice(words) for _ in xrange(words_per_doc))
+            for _ in xrange(n_docs)]
+
+
+def bench_tokenizers(docs=None, backends=None):
+    '''
+    Reports docs/sec for each tokenizer backend, and how many docs each
+        backend tokenizes differently from the 'nltk' backend.
+
+    INPUT:  list - docs (defaults to synthetic_articles),
+            list - backend names (defaults to all of nlp.TOKENIZERS)
+    OUTPUT: dict - docs/sec keyed by backend
+    '''
+    if docs is None:
+        docs = synthetic_articles()
+    if backends is None:
+        backends = sorted(nlp.TOKENIZERS)
+    golden = [nlp.clean_tokenize(d, 'nltk') for d in docs]
+    rates = {}
+    for backend in backends:
+        tokens, secs = _timed(lambda: [nlp.clean_tokenize(d, backend)
+                                       for d in docs])
+        rates[backend] = len(docs) / secs
+        mismatches = sum(1 for a, b in zip(golden, tokens) if a != b)
+        print '%-6s %10.1f docs/sec  %d mismatches' % (backend,
+                                                       rates[backend],
+                                                       mismatches)
+    return rates
+
+
+def synthetic_corpus(n_docs=20000, n_features=5000, n_topics=75,
+                     start_month='2001-10', n_months=160, seed=0):
+    '''
+    Builds a random scored corpus: a sparse TF-IDF-like X, a topic-term H,
+        article lengths and sorted pub_dates spread over n_months.
+
+    INPUT:  int - n_docs, int - n_features, int - n_topics,
+            string - start_month, int - n_months, int - seed
+    OUTPUT: 2d sparse array - X, 2d np array - H,
+            n x 1 np array - lengths, list - pub_dates, list - months
+    '''
+    rng = np.random.RandomState(seed)
+    X = sp.random(n_docs, n_features, density=.01, format='csr',
+                  random_state=rng)
+    H = rng.rand(n_topics, n_features)
+    lengths = rng.randint(30, 2000, size=(n_docs, 1)).astype(float)
+    months = [start_month]
+    while len(months) < n_months:
+        months.append(analysis._next_month(months[-1]))
+    pub_dates = sorted('%s-%02dT00:00:00Z' % (months[m], d) for m, d in
+                       zip(rng.randint(0, n_months, n_docs),
+                           rng.randint(1, 29, n_docs)))
+    return X, H, lengths, pub_dates, months
+
+
+def bench_empire_plot_counts(n_docs=20000, n_topics=75):
+    '''
+    Compares the month-by-month topic counts of empire_plot_counts with
+        the single-pass _monthly_topic_counts on a synthetic corpus.
+        Neither side touches mongo or the vectorizer, so this only
+        measures the scoring and bucketing.
+
+    INPUT:  int - n_docs, int - n_topics
+    OUTPUT: tuple - (float - loop seconds, float - single-pass seconds)
+    '''
+    X, H, lengths, pub_dates, months = synthetic_corpus(n_docs,
+                                                        n_topics=n_topics)
+    article_months = np.array([d[:7] for d in pub_dates])
+
+    def per_month():
+        counts = []
+        for m in months:
+            rows = np.flatnonzero(article_months == m)
+            dtf = X[rows].dot(H.T) / lengths[rows]
+            best = Counter(dtf.argmax(axis=1))
+            counts.append([best[i] for i in range(n_topics)])
+        return np.array(counts)
+
+    old, old_secs = _timed(per_month)
+    new, new_secs = _timed(analysis._monthly_topic_counts, X, H, lengths,
+                           pub_dates, months)
+    print 'empire counts: per month %.3fs, single pass %.3fs, same: %s' % (
+        old_secs, new_secs, np.array_equal(old, new))
+    return old_secs, new_secs
+
+
+def bench_best_articles_per_month(n_docs=100000, n_topics=200):
+    '''
+    Compares the per-record, per-topic scan that get_best_articles_per_month
+        used to run on each month with the segment-reduction
+        _best_per_group, on synthetic topic weights.
+
+    INPUT:  int - n_docs, int - n_topics
+    OUTPUT: tuple - (float - loop seconds, float - vectorized seconds)
+    '''
+    rng = np.random.RandomState(0)
+    weights = rng.rand(n_docs, n_topics).astype(np.float32)
+    ids = np.array(['id%d' % i for i in xrange(n_docs)])
+    _, _, _, pub_dates, months = synthetic_corpus(n_docs=n_docs,
+                                                  n_features=10)
+    month_idx = analysis._month_index(pub_dates, months)
+
+    def scan():
+        output = []
+        for m in xrange(len(months)):
+            best = [(None, 0.0)] * n_topics
+            for r in np.flatnonzero(month_idx == m):
+                for i, v in enumerate(weights[r]):
+                    if v > best[i][1]:
+                        best[i] = (ids[r], float(v))
+            output.append(best)
+        return output
+
+    old, old_secs = _timed(scan)
+    new, new_secs = _timed(analysis._best_per_group, ids, weights,
+                           month_idx, len(months))
+    print 'best per month: scan %.3fs, vectorized %.3fs, same: %s' % (
+        old_secs, new_secs, old == new)
+    return old_secs, new_secs
+
+
+def _nmf_run(args):
+    '''
+    Fits one topic model in a fresh process and reports its cost.
+
+    INPUT:  tuple - (string - 'batch' or 'minibatch', string - store path,
+            int - n_topics, int - chunk_size)
+    OUTPUT: tuple - (float - seconds, int - peak RSS in KB,
+            float - reconstruction error)
+    '''
+    method, path, n_topics, chunk_size = args
+    store = feature_store.FeatureStore(path)
+    t0 = time()
+    if method == 'batch':
+        X = store.rows(0, len(store))[0]
+        W, H = nlp.basic_nmf(X, n_topics, random_state=0)
+    else:
+        W, H, _ = nlp.minibatch_nmf(store, n_topics, chunk_size,
+                                    random_state=0)
+    secs = time() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    error = sum(np.linalg.norm(X - W[s:s + X.shape[0]].dot(H)) ** 2
+                for s, (X, _, _) in zip(xrange(0, len(store), chunk_size),
+                                        store.iter_chunks(chunk_size)))
+    return secs, peak, np.sqrt(error)
+
+
+def bench_nmf(n_docs=20000, n_features=5000, n_topics=50, chunk_size=2000):
+    '''
+    Compares wall-clock time, peak memory and reconstruction error of
+        basic_nmf and minibatch_nmf on a synthetic feature store. Each fit
+        runs in its own process so peak memory is measured separately.
+
+    INPUT:  int - n_docs, int - n_features, int - n_topics,
+            int - chunk_size
+    OUTPUT: dict - (seconds, peak RSS KB, error) keyed by method
+    '''
+    X, _, _, pub_dates, _ = synthetic_corpus(n_docs, n_features, n_topics)
+    path = tempfile.mkdtemp()
+    try:
+        feature_store.save_features(path, X, range(n_docs), pub_dates)
+        results = {}
+        for method in ['batch', 'minibatch']:
+            pool = Pool(1)
+            results[method] = pool.apply(_nmf_run, ((method, path, n_topics,
+                                                     chunk_size),))
+            pool.close()
+            pool.join()
+            print '%-9s nmf %8.2fs  peak %8d KB  error %.3f' % (
+                (method,) + results[method])
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def bench_current_events(n_docs=100000, n_topics=200, per_day=500,
+                         n_days=7):
+    '''
+    Measures how many scored articles per second a CurrentEventsWindow
+        takes in, on a synthetic feed of per_day articles a day.
+
+    INPUT:  int - n_docs, int - n_topics, int - per_day, int - n_days
+    OUTPUT: float - articles/sec
+    '''
+    rng = np.random.RandomState(0)
+    weights = rng.rand(n_docs, n_topics)
+    days = [date.fromordinal(date(2001, 9, 11).toordinal() + i // per_day)
+            .isoformat() for i in xrange(n_docs)]
+    window = analysis.CurrentEventsWindow(weights.sum(axis=0), n_days)
+
+    def feed():
+        for i in xrange(n_docs):
+            window.add(i, days[i], weights[i])
+        return window.flagged()
+
+    _, secs = _timed(feed)
+    print 'current events window: %.0f articles/sec' % (n_docs / secs)
+    return n_docs / secs
+
+
+if __name__ == '__main__':
+    bench_tokenizers()
+    bench_empire_plot_counts()
+    bench_best_articles_per_month()
+    bench_nmf()
+    bench_current_events()
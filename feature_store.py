@@ -0,0 +1,667 @@
+'''
+On-disk NumPy stores for the Always Remember project. Saves the TF-IDF
+    feature matrix so later steps can load rows by slice instead of
+    pulling clean_text out of mongo and re-vectorizing it, and keeps a
+    columnar copy of each model's topic weights for the analysis steps.
+    Fitted models can be saved as plain arrays too, so analyzers
+    memory-map them instead of unpickling sklearn objects, and daily
+    topic aggregates are kept in a TopicCube for date-range queries.
+'''
+import os
+from datetime import date
+import hashlib
+import operator
+import numpy as np
+import scipy.sparse as sp
+import simplejson as json
+from bson.binary import Binary
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+def vectorizer_fingerprint(vec):
+    '''
+    Hashes a fitted vectorizer's parameters and idf weights, so a stored
+        feature matrix can be matched to the vectorizer that built it.
+
+    INPUT:  vectorizer object - vec
+    OUTPUT: string - hex digest
+    '''
+    params = sorted((k, repr(v)) for k, v in vec.get_params().iteritems())
+    h = hashlib.md5(repr(params))
+    if hasattr(vec, 'idf_'):
+        h.update(np.ascontiguousarray(vec.idf_).tostring())
+    return h.hexdigest()
+
+
+def save_features(path, X, article_ids, pub_dates, vec=None, lengths=None):
+    '''
+    Saves a feature matrix as memory-mappable CSR arrays in directory path,
+        with rows sorted by pub_date. Alongside X it keeps the row->_id
+        index, the pub_date column, article word counts (if given) and
+        the fingerprint of the vectorizer that built X. A store saved
+        without lengths can't be used where articles are normalized by
+        length (see FeatureStore.check).
+
+    INPUT:  string - path, 2d sparse array - X, list - article_ids,
+            list - pub_dates, vectorizer object - vec,
+            list - lengths (word count per article)
+    OUTPUT: FeatureStore - the saved store
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    pub_dates = np.array(pub_dates, dtype=unicode)
+    order = np.argsort(pub_dates, kind='mergesort')
+    X = sp.csr_matrix(X)[order]
+    X.sort_indices()
+    arrays = {'data': X.data,
+              'indices': X.indices,
+              'indptr': X.indptr,
+              'ids': np.array([unicode(i) for i in article_ids],
+                              dtype=unicode)[order],
+              'pub_dates': pub_dates[order]}
+    if lengths is not None:
+        arrays['lengths'] = np.asarray(lengths, dtype=np.int32)[order]
+    for name, arr in arrays.iteritems():
+        np.save(os.path.join(path, name + '.npy'), arr)
+    fingerprint = vectorizer_fingerprint(vec) if vec is not None else None
+    meta = {'shape': X.shape, 'fingerprint': fingerprint,
+            'has_lengths': lengths is not None}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return FeatureStore(path)
+
+
+def build_feature_store(table, vec, path, query={}, fit=False):
+    '''
+    Vectorizes the clean text of query-matching records and saves the
+        result with save_features. Set fit to fit vec on these records
+        first.
+
+    INPUT:  mongo-collection - table, vectorizer object - vec,
+            string - path, dict - mongo query, bool - fit
+    OUTPUT: FeatureStore - the saved store
+    '''
+    q = {'clean_text': {'$exists': True, '$ne': ''}}
+    q.update(query)
+    cursor = table.find(q, {'clean_text': 1, 'pub_date': 1})
+    records = [(c['_id'], c['pub_date'], c['clean_text']) for c in cursor]
+    texts = [r[2] for r in records]
+    X = vec.fit_transform(texts) if fit else vec.transform(texts)
+    return save_features(path, X, [r[0] for r in records],
+                         [r[1] for r in records], vec,
+                         [len(t.split()) for t in texts])
+
+
+class FeatureStore(object):
+    '''
+    Read-only view of a feature matrix saved by save_features. Arrays are
+        memory-mapped, so loading is instant and only the rows that are
+        used get read from disk.
+
+    INPUT:  string - path, bool - mmap
+    '''
+    def __init__(self, path, mmap=True):
+        self.path = path
+        mode = 'r' if mmap else None
+        load = lambda name: np.load(os.path.join(path, name + '.npy'),
+                                    mmap_mode=mode)
+        self.data = load('data')
+        self.indices = load('indices')
+        self.indptr = load('indptr')
+        self.ids = load('ids')
+        self.pub_dates = load('pub_dates')
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.fingerprint = meta['fingerprint']
+        self.lengths = None
+        if meta.get('has_lengths', True):
+            self.lengths = load('lengths')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def check(self, vec, lengths=False):
+        '''
+        Raises ValueError unless vec is the vectorizer that built the store
+            and, if lengths, the store has article lengths.
+
+        INPUT:  vectorizer object - vec, bool - lengths
+        OUTPUT: None
+        '''
+        if vectorizer_fingerprint(vec) != self.fingerprint:
+            raise ValueError('feature store %s was built by a different '
+                             'vectorizer' % self.path)
+        if lengths and self.lengths is None:
+            raise ValueError('feature store %s was saved without article '
+                             'lengths' % self.path)
+
+    def rows(self, start, stop):
+        '''
+        Loads a contiguous block of rows.
+
+        INPUT:  int - start, int - stop
+        OUTPUT: 2d sparse array - X rows, np array - article ids,
+                n x 1 np array - article lengths (None if not saved)
+        '''
+        lo, hi = self.indptr[start], self.indptr[stop]
+        X = sp.csr_matrix((np.asarray(self.data[lo:hi]),
+                           np.asarray(self.indices[lo:hi]),
+                           np.asarray(self.indptr[start:stop + 1]) - lo),
+                          shape=(stop - start, self.shape[1]))
+        lengths = None
+        if self.lengths is not None:
+            lengths = np.asarray(self.lengths[start:stop],
+                                 dtype=float).reshape(-1, 1)
+        return X, np.asarray(self.ids[start:stop]), lengths
+
+    def date_range(self, start_date, end_date):
+        '''
+        Loads the rows published in a date range, matching the mongo
+            query {'pub_date': {'$gte': start_date, '$lte': end_date}}.
+
+        INPUT:  string - start_date, string - end_date
+        OUTPUT: same as rows
+        '''
+        return self.rows(*self.date_slice(start_date, end_date))
+
+    def date_slice(self, start_date, end_date):
+        '''
+        Finds the row bounds of a date range (see date_range).
+
+        INPUT:  string - start_date, string - end_date
+        OUTPUT: tuple - (int - start row, int - stop row)
+        '''
+        start = np.searchsorted(self.pub_dates, start_date, side='left')
+        stop = np.searchsorted(self.pub_dates, end_date, side='right')
+        return start, stop
+
+    def iter_chunks(self, chunk_size=10000):
+        '''
+        Iterates over the whole store in blocks of chunk_size rows.
+
+        INPUT:  int - chunk_size
+        OUTPUT: generator - outputs of rows
+        '''
+        for start in xrange(0, len(self), chunk_size):
+            yield self.rows(start, min(start + chunk_size, len(self)))
+
+
+def encode_topic_weights(weights, top_k, floor=0.):
+    '''
+    Encodes each row of weights as its top_k (topic, weight) pairs above
+        floor, strongest first, for storing in mongo instead of a dense
+        list: {'n': number of topics, 'topics': uint16 bytes,
+        'weights': float32 bytes}. decode_topic_weights reverses it.
+
+    INPUT:  2d numpy array - weights (articles x topics), int - top_k,
+            float - floor
+    OUTPUT: list - encoded rows
+    '''
+    weights = np.asarray(weights)
+    num_topics = weights.shape[1]
+    k = min(top_k, num_topics)
+    rows = np.arange(len(weights))[:, np.newaxis]
+    top = np.argpartition(-weights, k - 1, axis=1)[:, :k]
+    order = np.argsort(-weights[rows, top], axis=1, kind='mergesort')
+    top = top[rows, order]
+    top_weights = weights[rows, top]
+    encoded = []
+    for topics, w in zip(top, top_weights):
+        keep = w > floor
+        encoded.append({'n': num_topics,
+                        'topics': Binary(topics[keep].astype(np.uint16)
+                                         .tostring()),
+                        'weights': Binary(w[keep].astype(np.float32)
+                                          .tostring())})
+    return encoded
+
+
+def decode_topic_weights(values, num_topics=0, sparse=False):
+    '''
+    Rebuilds a weights matrix from stored model fields, each either a
+        dense list of weights or a row from encode_topic_weights (topics
+        left out are 0). num_topics sets the width when values is empty.
+
+    INPUT:  list - stored values, int - num_topics, bool - sparse
+    OUTPUT: 2d numpy array - weights, or a CSR matrix if sparse
+    '''
+    if not sparse and all(isinstance(v, list) for v in values):
+        if not values:
+            return np.zeros((0, num_topics))
+        return np.array(values)
+    indices, data, indptr = [], [], [0]
+    for v in values:
+        if isinstance(v, dict):
+            topics = np.frombuffer(v['topics'], dtype=np.uint16)
+            w = np.frombuffer(v['weights'], dtype=np.float32)
+            num_topics = v['n']
+        else:
+            w = np.asarray(v, dtype=float)
+            num_topics = len(w)
+            topics = np.flatnonzero(w)
+            w = w[topics]
+        indices.append(topics)
+        data.append(w)
+        indptr.append(indptr[-1] + len(topics))
+    if values:
+        indices, data = np.concatenate(indices), np.concatenate(data)
+    X = sp.csr_matrix((np.asarray(data, dtype=float),
+                       np.asarray(indices, dtype=np.int32), indptr),
+                      shape=(len(values), num_topics))
+    return X if sparse else X.toarray()
+
+
+def save_topic_weights(path, model_name, ids, pub_dates, weights,
+                       types=None, append=True):
+    '''
+    Saves a model's topic weights to directory path as a float32
+        (articles x topics) .npy array with aligned _id, pub_date and
+        type_of_material columns. With append, adds the rows to the
+        cache already stored for model_name.
+
+    INPUT:  string - path, string - model_name, list - ids,
+            list - pub_dates, 2d numpy array - weights,
+            list - types (type_of_material), bool - append
+    OUTPUT: None
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if types is None:
+        types = [''] * len(ids)
+    columns = {'ids': np.array([unicode(i) for i in ids], dtype=unicode),
+               'pub_dates': np.array(pub_dates, dtype=unicode),
+               'types': np.array(types, dtype=unicode),
+               'weights': np.asarray(weights, dtype=np.float32)}
+    if append and os.path.exists(_weights_file(path, model_name, 'ids')):
+        old = TopicWeightStore(path, model_name)
+        for name in columns:
+            columns[name] = np.concatenate([getattr(old, name),
+                                            columns[name]])
+        del old  # release the memory maps before overwriting
+    for name, arr in columns.iteritems():
+        np.save(_weights_file(path, model_name, name), arr)
+
+
+def cache_topic_weights(table, model_name, path, batch_size=10000):
+    '''
+    Rebuilds the topic weight cache for model_name from every record in
+        the table that has weights for it.
+
+    INPUT:  mongo-collection - table, string - model_name, string - path,
+            int - batch_size
+    OUTPUT: TopicWeightStore - the cache
+    '''
+    cursor = table.find({model_name: {'$exists': True}},
+                        {model_name: 1, 'pub_date': 1,
+                         'type_of_material': 1})
+    append = False
+    batch = []
+    for record in cursor:
+        batch.append(record)
+        if len(batch) == batch_size:
+            _cache_records(path, model_name, batch, append)
+            batch, append = [], True
+    if batch or not append:
+        _cache_records(path, model_name, batch, append)
+    return TopicWeightStore(path, model_name)
+
+
+def _cache_records(path, model_name, records, append):
+    '''
+    Saves a list of mongo records to the topic weight cache.
+    '''
+    weights = decode_topic_weights([r[model_name] for r in records])
+    save_topic_weights(path, model_name, [r['_id'] for r in records],
+                       [r['pub_date'] for r in records], weights,
+                       [r.get('type_of_material', '') for r in records],
+                       append)
+
+
+def _weights_file(path, model_name, name):
+    '''
+    Path of one column of a model's topic weight cache.
+    '''
+    return os.path.join(path, '%s_%s.npy' % (model_name, name))
+
+
+_DATE_OPS = {'$gt': operator.gt, '$gte': operator.ge,
+             '$lt': operator.lt, '$lte': operator.le}
+
+
+class TopicWeightStore(object):
+    '''
+    Read-only, memory-mapped view of a model's cached topic weights.
+
+    INPUT:  string - path, string - model_name, bool - mmap
+    '''
+    def __init__(self, path, model_name, mmap=True):
+        mode = 'r' if mmap else None
+        load = lambda name: np.load(_weights_file(path, model_name, name),
+                                    mmap_mode=mode)
+        self.model_name = model_name
+        self.ids = load('ids')
+        self.pub_dates = load('pub_dates')
+        self.types = load('types')
+        self.weights = load('weights')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, date_query=None, type_of_material='News'):
+        '''
+        Loads the rows matching a mongo-style pub_date condition (such as
+            {'$gte': '2001-09', '$lt': '2014-11'}) and type_of_material
+            (None for any).
+
+        INPUT:  dict - date_query, string - type_of_material
+        OUTPUT: np array - ids, np array - pub_dates,
+                2d np array - weights
+        '''
+        rows = self._rows(date_query, type_of_material)
+        return (np.asarray(self.ids)[rows], np.asarray(self.pub_dates)[rows],
+                self.weights[rows])
+
+    def iter_select(self, date_query=None, type_of_material='News',
+                    chunk_size=10000):
+        '''
+        Streams the rows select would load in chunks of chunk_size, so only
+            one chunk of weights is in memory at a time.
+
+        INPUT:  dict - date_query, string - type_of_material,
+                int - chunk_size
+        OUTPUT: generator - (np array ids, 2d np array weights) chunks
+        '''
+        rows = self._rows(date_query, type_of_material)
+        for start in xrange(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            yield np.asarray(self.ids)[chunk], self.weights[chunk]
+
+    def _rows(self, date_query, type_of_material):
+        '''
+        Finds the row numbers matching select's conditions.
+        '''
+        pub_dates = np.asarray(self.pub_dates)
+        mask = np.ones(len(self), dtype=bool)
+        if type_of_material is not None:
+            mask &= np.asarray(self.types) == type_of_material
+        for op, value in (date_query or {}).iteritems():
+            mask &= _DATE_OPS[op](pub_dates, value)
+        return np.flatnonzero(mask)
+
+
+def save_model_artifacts(path, vec, H, topic_filter=None):
+    '''
+    Saves a fitted vectorizer and topic-term matrix to directory path as
+        plain arrays: H.npy (with topic_filter already applied), idf.npy,
+        the term of each column (terms.npy, plus term_cols.npy for a
+        HashingTfidf) and the vectorizer's non-default parameters in
+        model.json. Load them with load_vectorizer and load_topic_matrix.
+
+    INPUT:  string - path, vectorizer object - vec,
+            2d numpy array - H, np array - topic_filter
+    OUTPUT: None
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    H = np.asarray(H)
+    if topic_filter is not None:
+        H = H[topic_filter]
+        np.save(_artifact_file(path, 'topic_filter'), topic_filter)
+    hashing = hasattr(vec, 'hasher')
+    if hashing:
+        cols = sorted(vec.terms)
+        terms = [vec.terms[c] for c in cols]
+        np.save(_artifact_file(path, 'term_cols'),
+                np.array(cols, dtype=np.int64))
+    else:
+        terms = vec.get_feature_names()
+    np.save(_artifact_file(path, 'H'), H)
+    np.save(_artifact_file(path, 'idf'), np.asarray(vec.idf_, dtype=float))
+    np.save(_artifact_file(path, 'terms'), np.array(terms, dtype=unicode))
+    meta = {'kind': 'hashing' if hashing else 'tfidf',
+            'params': _changed_params(vec)}
+    with open(os.path.join(path, 'model.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_vectorizer(path):
+    '''
+    Rebuilds the fitted vectorizer saved by save_model_artifacts. It
+        transforms exactly like the original and has the same
+        vectorizer_fingerprint.
+
+    INPUT:  string - path
+    OUTPUT: vectorizer object - vec
+    '''
+    with open(os.path.join(path, 'model.json')) as f:
+        meta = json.load(f)
+    params = meta['params']
+    if 'ngram_range' in params:
+        params['ngram_range'] = tuple(params['ngram_range'])
+    if 'dtype' in params:
+        params['dtype'] = np.dtype(params['dtype']).type
+    terms = np.load(_artifact_file(path, 'terms')).tolist()
+    if meta['kind'] == 'hashing':
+        from nlp import HashingTfidf  # nlp imports this module
+        vec = HashingTfidf(**params)
+        cols = np.load(_artifact_file(path, 'term_cols')).tolist()
+        vec.terms = dict(zip(cols, terms))
+    else:
+        vec = TfidfVectorizer(**params)
+        vec.vocabulary_ = dict((t, i) for i, t in enumerate(terms))
+    vec.idf_ = np.load(_artifact_file(path, 'idf'))
+    return vec
+
+
+def load_topic_matrix(path, mmap=True):
+    '''
+    Loads the H saved by save_model_artifacts, memory-mapped read-only by
+        default so processes using the same model share its pages.
+
+    INPUT:  string - path, bool - mmap
+    OUTPUT: 2d numpy array - H
+    '''
+    return np.load(_artifact_file(path, 'H'), mmap_mode='r' if mmap else None)
+
+
+def load_topic_filter(path):
+    '''
+    Loads the topic_filter H was saved with, or None.
+
+    INPUT:  string - path
+    OUTPUT: np array - topic_filter
+    '''
+    filename = _artifact_file(path, 'topic_filter')
+    return np.load(filename) if os.path.exists(filename) else None
+
+
+def _changed_params(vec):
+    '''
+    The parameters of vec that differ from its class defaults, in a form
+        json can store.
+    '''
+    defaults = type(vec)().get_params()
+    params = {}
+    for k, v in vec.get_params().iteritems():
+        if k in defaults and v == defaults[k]:
+            continue
+        if k == 'dtype':
+            v = np.dtype(v).name
+        elif callable(v):
+            raise ValueError('cannot save vectorizer parameter %s=%r; '
+                             'pickle this vectorizer instead' % (k, v))
+        params[k] = v
+    return params
+
+
+def _artifact_file(path, name):
+    '''
+    Path of one array of a model saved by save_model_artifacts.
+    '''
+    return os.path.join(path, name + '.npy')
+
+
+class TopicCube(object):
+    '''
+    Per-day topic aggregates of a scored corpus, with prefix sums so the
+        totals for any date range take two lookups instead of a corpus
+        scan. Each day keeps its article count and, per topic, the sum of
+        raw document-topic weights, the number of articles whose best
+        topic it is, the number whose length-normalized weight exceeds
+        doc_topic_threshold and the number having it among their top_k
+        topics. Adding articles updates the day totals in place; the
+        prefix sums are rebuilt on the next query. last_date is the newest
+        pub_date added so far, so callers can add just the articles after
+        it.
+
+    INPUT:  int - num_topics, float - doc_topic_threshold, int - top_k
+    '''
+    STATS = ['articles', 'weight_sums', 'best_counts', 'threshold_counts',
+             'top_k_counts']
+
+    def __init__(self, num_topics, doc_topic_threshold=.1, top_k=3):
+        self.num_topics = num_topics
+        self.doc_topic_threshold = doc_topic_threshold
+        self.top_k = top_k
+        self.first_day = None
+        self.last_date = None
+        self.articles = np.zeros(0, dtype=np.int64)
+        self.weight_sums = np.zeros((0, num_topics))
+        self.best_counts = np.zeros((0, num_topics), dtype=np.int64)
+        self.threshold_counts = np.zeros((0, num_topics), dtype=np.int64)
+        self.top_k_counts = np.zeros((0, num_topics), dtype=np.int64)
+        self._prefix = None
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a cube saved with save.
+
+        INPUT:  string - path
+        OUTPUT: TopicCube
+        '''
+        with open(os.path.join(path, 'cube.json')) as f:
+            meta = json.load(f)
+        cube = cls(meta['num_topics'], meta['doc_topic_threshold'],
+                   meta['top_k'])
+        cube.first_day = meta['first_day']
+        cube.last_date = meta.get('last_date')
+        for name in cls.STATS:
+            setattr(cube, name, np.load(os.path.join(path, name + '.npy')))
+        return cube
+
+    def save(self, path):
+        '''
+        Saves the day totals and settings to directory path.
+
+        INPUT:  string - path
+        OUTPUT: None
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.STATS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'num_topics': self.num_topics, 'top_k': self.top_k,
+                'doc_topic_threshold': self.doc_topic_threshold,
+                'first_day': self.first_day, 'last_date': self.last_date}
+        with open(os.path.join(path, 'cube.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def add(self, pub_dates, doc_topic_freqs, lengths):
+        '''
+        Adds scored articles to their days and moves last_date up to the
+            newest of their pub_dates. Articles must not be added twice.
+
+        INPUT:  list - pub_dates, 2d numpy array - doc_topic_freqs (raw
+                X.dot(H.T) weights, articles x topics),
+                n x 1 np array - article lengths
+        OUTPUT: None
+        '''
+        dtf = np.asarray(doc_topic_freqs, dtype=float)
+        if len(dtf) == 0:
+            return
+        days = np.array([date(int(d[:4]), int(d[5:7]),
+                              int(d[8:10])).toordinal() for d in pub_dates])
+        self._extend(days.min(), days.max())
+        newest = unicode(max(pub_dates))
+        if self.last_date is None or newest > self.last_date:
+            self.last_date = newest
+        rows = days - self.first_day
+        n_days, n = len(self.articles), len(rows)
+        by_day = sp.csr_matrix((np.ones(n), (rows, np.arange(n))),
+                               shape=(n_days, n))
+        normalized = dtf / np.asarray(lengths, dtype=float).reshape(-1, 1)
+        k = min(self.top_k, self.num_topics)
+        top = np.argpartition(normalized, -k, axis=1)[:, -k:]
+        over, topics = np.nonzero(normalized > self.doc_topic_threshold)
+
+        self.articles += np.bincount(rows, minlength=n_days)
+        self.weight_sums += by_day.dot(dtf)
+        self.best_counts += self._cell_counts(rows, normalized.argmax(axis=1))
+        self.threshold_counts += self._cell_counts(rows[over], topics)
+        self.top_k_counts += self._cell_counts(np.repeat(rows, k),
+                                               top.ravel())
+        self._prefix = None
+
+    def range_sum(self, start_date, end_date, stat='best_counts'):
+        '''
+        Totals one of STATS over the articles a mongo query
+            {'pub_date': {'$gte': start_date, '$lte': end_date}} would
+            match. Dates can be given to the day at most ('YYYY',
+            'YYYY-MM' or 'YYYY-MM-DD').
+
+        INPUT:  string - start_date, string - end_date, string - stat
+        OUTPUT: np array - per-topic totals (or int - for 'articles')
+        '''
+        if len(start_date) > 10 or len(end_date) > 10:
+            raise ValueError('TopicCube dates are days; got %s, %s' %
+                             (start_date, end_date))
+        if self._prefix is None:
+            self._build_prefix()
+        days, prefix = self._prefix[0], self._prefix[1][stat]
+        # a pub_date such as 'YYYY-MM-DDThh:mm:ssZ' is <= end_date exactly
+        # when its day is < end_date
+        lo = np.searchsorted(days, start_date, side='left')
+        hi = max(np.searchsorted(days, end_date, side='left'), lo)
+        return prefix[hi] - prefix[lo]
+
+    def _build_prefix(self):
+        '''
+        Rebuilds the day labels and the prefix sums of every stat.
+        '''
+        n_days = len(self.articles)
+        first = self.first_day or 0
+        days = np.array([date.fromordinal(first + i).isoformat()
+                         for i in xrange(n_days)], dtype=unicode)
+        prefix = {}
+        for name in self.STATS:
+            values = getattr(self, name)
+            zero = np.zeros((1,) + values.shape[1:], dtype=values.dtype)
+            prefix[name] = np.concatenate([zero, np.cumsum(values, axis=0)])
+        self._prefix = (days, prefix)
+
+    def _extend(self, lo, hi):
+        '''
+        Grows the day arrays to cover day ordinals lo through hi.
+        '''
+        lo, hi = int(lo), int(hi)
+        if self.first_day is None:
+            self.first_day = lo
+        before = max(self.first_day - lo, 0)
+        after = max(hi - (self.first_day + len(self.articles) - 1), 0)
+        if before or after:
+            for name in self.STATS:
+                values = getattr(self, name)
+                pad = [(before, after)] + [(0, 0)] * (values.ndim - 1)
+                setattr(self, name, np.pad(values, pad, 'constant'))
+            self.first_day -= before
+
+    def _cell_counts(self, rows, topics):
+        '''
+        Counts (day row, topic) pairs into a days x topics array.
+        '''
+        n_days = len(self.articles)
+        counts = np.bincount(rows * self.num_topics + topics,
+                             minlength=n_days * self.num_topics)
+        return counts.reshape(n_days, self.num_topics)
@@ -1,9 +1,42 @@
 '''
-Standalone functions and reports on the mongo db.
+Standalone functions and reports on the mongo db. Queries here project
+    only the fields their callers use, so full article texts are never
+    shipped around just to read a date.
 '''
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 from collections import Counter
 
+# (keys, options) for the indexes the scraping and analysis queries use
+RECOMMENDED_INDEXES = [([('web_url', ASCENDING)], {'unique': True}),
+                       ([('pub_date', ASCENDING)], {}),
+                       ([('type_of_material', ASCENDING),
+                         ('pub_date', ASCENDING)], {})]
+
+
+def ensure_indexes(table, model_names=()):
+    '''
+    Creates the RECOMMENDED_INDEXES, plus one partial (pub_date,
+        type_of_material, <model>.n) index per model covering just the
+        records that have weights for that model. Existing indexes are
+        left alone.
+
+    INPUT:  mongo-collection - table, list - model names
+    OUTPUT: list - index names
+    '''
+    names = [table.create_index(keys, **options)
+             for keys, options in RECOMMENDED_INDEXES]
+    for model_name in model_names:
+        # mongod < 5.0 refuses two indexes with the same keys, whatever
+        # their partial filters; the trailing '.n' key (topic count of
+        # encoded weights, null for dense lists) tells the models apart
+        # without indexing the weights themselves
+        names.append(table.create_index(
+            [('pub_date', ASCENDING), ('type_of_material', ASCENDING),
+             (model_name + '.n', ASCENDING)],
+            name=model_name + '_pub_date',
+            partialFilterExpression={model_name: {'$exists': True}}))
+    return names
+
 
 def records_by_month(table, query={}):
     '''
@@ -13,12 +46,26 @@ def records_by_month(table, query={}):
     OUTPUT: dict - record counts keyed by year-month string
     '''
     mc = Counter()
-    for record in table.find(query):
+    for record in table.find(query, {'pub_date': 1, '_id': 0}):
         month = record['pub_date'][:7]
         mc[month] += 1
     return mc
 
 
+def records_by_month_agg(table, query={}):
+    '''
+    Same report as records_by_month, counted by the server with an
+        aggregation pipeline so only one row per month comes back.
+
+    INPUT:  mongo-collection - table, dict - query
+    OUTPUT: dict - record counts keyed by year-month string
+    '''
+    pipeline = [{'$match': query},
+                {'$group': {'_id': {'$substr': ['$pub_date', 0, 7]},
+                            'count': {'$sum': 1}}}]
+    return Counter({r['_id']: r['count'] for r in table.aggregate(pipeline)})
+
+
 def just_clean_text(table, query={}):
     '''
     Gets the clean text from every query-matching record in the table.
@@ -26,7 +73,44 @@ def just_clean_text(table, query={}):
     INPUT:  mongo-collection table, dict - query
     OUTPUT: list - clean document strings
     '''
+    query = dict(query)
     query['clean_text'] = {'$exists': True, '$ne': ''}
-    cursor = table.find(query)
+    cursor = table.find(query, {'clean_text': 1})
     results = [(c['_id'], c['clean_text']) for c in cursor]
     return results
+
+
+def records_by_id(table, ids, fields, chunk_size=1000):
+    '''
+    Fetches many records with a few $in queries (chunk_size ids each),
+        projected to just the given fields.
+
+    INPUT:  mongo-collection - table, iterable - ids, list - field names,
+            int - chunk_size
+    OUTPUT: dict - records keyed by _id
+    '''
+    projection = {f: 1 for f in fields}
+    unique_ids = list(set(i for i in ids if i is not None))
+    records = {}
+    for chunk in batches(unique_ids, chunk_size):
+        for record in table.find({'_id': {'$in': chunk}}, projection):
+            records[record['_id']] = record
+    return records
+
+
+def batches(iterable, batch_size):
+    '''
+    Groups an iterable (such as a cursor) into lists of batch_size items;
+        the last list may be shorter.
+
+    INPUT:  iterable, int - batch_size
+    OUTPUT: generator - lists
+    '''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -3,28 +3,59 @@ Natural Language Processing functionality for the Always Remember project.
 
 Dan Morris 11/3/14 - 11/20/14
 '''
-from string import punctuation
+import re
+from copy import deepcopy
+from collections import deque, Counter
+from multiprocessing import Pool, cpu_count
+from string import punctuation, maketrans, ascii_lowercase, ascii_uppercase
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from sklearn.decomposition import NMF
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from feature_store import save_features
+from mongo_stuff import batches
 
 ADDITIONAL_STOPWORDS = ['said', 'would', 'like', 'many', 'also', 'could',
                         'mr', 'ms', 'mrs', 'may', 'even', 'say', 'much',
                         'going', 'might', 'dont', 'go', 'another', 'around',
                         'says', 'editor']
-ALL_STOPWORDS = set(stopwords.words('english') + ADDITIONAL_STOPWORDS)
+ALL_STOPWORDS = frozenset(stopwords.words('english') + ADDITIONAL_STOPWORDS)
 
+# lookup tables for the 'fast' tokenizer backend
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+_NON_ASCII_BYTES = re.compile('[\x80-\xff]')
+_LOWERCASE = maketrans(ascii_uppercase, ascii_lowercase)
+# the only word_tokenize splits left once punctuation is gone
+_TREEBANK_SPLITS = {'cannot': ['can', 'not'], 'gimme': ['gim', 'me'],
+                    'gonna': ['gon', 'na'], 'gotta': ['got', 'ta'],
+                    'lemme': ['lem', 'me'], 'wanna': ['wan', 'na']}
 
-def clean_tokenize(doc):
+
+def clean_tokenize(doc, backend='nltk'):
     '''
     Cleans a document of stopwords, symbols, and punctuation.
+    backend picks the tokenizer from TOKENIZERS: 'nltk' runs NLTK's
+        word_tokenize, 'fast' gives the same tokens with translate tables
+        and a whitespace split.
+
+    INPUT:  string - dirty document, string - backend
+    OUTPUT: list - clean tokens!
+    '''
+    return TOKENIZERS[backend](doc)
+
+
+def _nltk_tokenize(doc):
+    '''
+    Tokenizer backend built on NLTK's word_tokenize.
 
     INPUT:  string - dirty document
-    OUTPUT: string - clean document!
+    OUTPUT: list - clean tokens
     '''
     doc = str(''.join([i if ord(i) < 128 else ' ' for i in doc])).lower()
     doc = doc.translate(None, punctuation)
@@ -36,14 +67,41 @@ def clean_tokenize(doc):
     return clean
 
 
-def clean_these_docs(table, records, verbose=False):
+def _fast_tokenize(doc):
+    '''
+    Tokenizer backend built on one regex substitution and one translate
+        pass (lowercase + strip punctuation) followed by a whitespace
+        split. Produces the same tokens as _nltk_tokenize.
+
+    INPUT:  string - dirty document
+    OUTPUT: list - clean tokens
+    '''
+    if isinstance(doc, unicode):
+        doc = _NON_ASCII.sub(u' ', doc).encode('ascii')
+    else:
+        doc = _NON_ASCII_BYTES.sub(' ', doc)
+    doc = doc.translate(_LOWERCASE, punctuation)
+    clean = []
+    for word in doc.split():
+        if word in _TREEBANK_SPLITS:
+            clean.extend(w for w in _TREEBANK_SPLITS[word]
+                         if w not in ALL_STOPWORDS)
+        elif word not in ALL_STOPWORDS:
+            clean.append(word)
+    return clean
+
+
+TOKENIZERS = {'nltk': _nltk_tokenize, 'fast': _fast_tokenize}
+
+
+def clean_these_docs(table, records, verbose=False, backend='nltk'):
     '''
     Cleans all documents in this list of records, adding the clean
         version back into the record. Generally used during an
         active scrape.
 
     INPUT:  mongo-collection - table, list - document record dicts,
-            bool - verbose
+            bool - verbose, string - tokenizer backend
     OUTPUT: None
     '''
     i = 0
@@ -52,8 +110,9 @@ def clean_these_docs(table, records, verbose=False):
         if verbose and i % 100 == 0:
             print 'cleaning doc # ', i
         try:
-            full_text = table.find_one({'_id': r['_id']})['full_text']
-            clean_text = ' '.join(clean_tokenize(full_text))
+            full_text = table.find_one({'_id': r['_id']},
+                                       {'full_text': 1})['full_text']
+            clean_text = ' '.join(clean_tokenize(full_text, backend))
             table.update({'_id': r['_id']},
                          {'$set': {'clean_text': clean_text}},
                          upsert=True)
@@ -61,29 +120,36 @@ def clean_these_docs(table, records, verbose=False):
             print 'failed to tokenize record: id ', r['_id']
 
 
-def clean_all_docs(table, overwrite=False, verbose=False):
+def clean_all_docs(table, overwrite=False, verbose=False, n_jobs=None,
+                   batch_size=500, backend='nltk'):
     '''
     Cleans all documents in the table and inserts the clean version into
         the record. Defaults to only process docs without an existing
         clean version. Toggle 'overwrite' to guarantee that all docs
-        in the table are cleaned.
+        in the table are cleaned. Set n_jobs to clean batches of
+        batch_size docs in a process pool (-1 for one per core).
 
-    INPUT:  mongo-collection - table, bool - overwrite, bool - verbose
+    INPUT:  mongo-collection - table, bool - overwrite, bool - verbose,
+            int - n_jobs, int - batch_size, string - tokenizer backend
     OUTPUT: None
     '''
     mongo_query = {'full_text': {'$exists': True, '$ne': ''},
                    'type_of_material': 'News'}
     if not overwrite:
         mongo_query['clean_text'] = {'$exists': False}
+    if n_jobs:
+        _clean_docs_parallel(table, mongo_query, n_jobs, batch_size, verbose,
+                             backend)
+        return
     i = 0
     total_count = table.find(mongo_query).count()
     print 'cleaning ', total_count, ' docs...'
-    for record in table.find(mongo_query):
+    for record in table.find(mongo_query, {'full_text': 1, 'web_url': 1}):
         i += 1
         if verbose and i % 500 == 0:
             print 'cleaning doc # ', i
         try:
-            clean_doc = ' '.join(clean_tokenize(record['full_text']))
+            clean_doc = ' '.join(clean_tokenize(record['full_text'], backend))
         except:
             print 'failed to tokenize record: id ', record['_id']
             continue
@@ -92,46 +158,268 @@ def clean_all_docs(table, overwrite=False, verbose=False):
                      upsert=True)
 
 
+def _clean_docs_parallel(table, query, n_jobs, batch_size, verbose=False,
+                         backend='nltk'):
+    '''
+    Streams query-matching records to a process pool in batches and
+        writes each cleaned batch back with a single bulk_write. At most
+        two batches per worker are in flight, so memory stays bounded.
+
+    INPUT:  mongo-collection - table, dict - mongo query, int - n_jobs,
+            int - batch_size, bool - verbose, string - tokenizer backend
+    OUTPUT: None
+    '''
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    pool = Pool(n_jobs)
+    pending = deque()
+    cleaned = 0
+
+    def write(batch):
+        ops = []
+        for _id, clean_doc in batch:
+            if clean_doc is None:
+                print 'failed to tokenize record: id ', _id
+            else:
+                ops.append(UpdateOne({'_id': _id},
+                                     {'$set': {'clean_text': clean_doc}}))
+        if ops:
+            table.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    try:
+        cursor = table.find(query, {'full_text': 1})
+        records = ((r['_id'], r['full_text']) for r in cursor)
+        for batch in batches(records, batch_size):
+            pending.append(pool.apply_async(_clean_batch, (batch, backend)))
+            if len(pending) >= 2 * n_jobs:
+                cleaned += write(pending.popleft().get())
+                if verbose:
+                    print 'cleaned ', cleaned, ' docs'
+        while pending:
+            cleaned += write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    if verbose:
+        print 'cleaned ', cleaned, ' docs'
+
+
+def _clean_batch(batch, backend='nltk'):
+    '''
+    Process pool worker: cleans a batch of documents.
+
+    INPUT:  list - (_id, full_text) tuples, string - tokenizer backend
+    OUTPUT: list - (_id, clean_text OR None if tokenizing failed) tuples
+    '''
+    output = []
+    for _id, full_text in batch:
+        try:
+            output.append((_id, ' '.join(clean_tokenize(full_text,
+                                                         backend))))
+        except:
+            output.append((_id, None))
+    return output
+
+
 def docs_tfidf(clean_articles, max_features=5000, ngram_range=(1, 1),
-               max_df=.8):
+               max_df=.8, hashing=False, n_jobs=None, n_features=2 ** 18):
     '''
     Builds a TF-IDF vectorizer using a list of clean article strings.
+        Set hashing to use HashingTfidf with n_features hashed columns
+        (vectorized by n_jobs processes) instead of a vocabulary of
+        max_features terms. Hashing needs far more columns than a
+        vocabulary to keep n-grams from colliding.
 
     INPUT:  list - clean_articles, int - max_features,
-            tuple - ngram_range, float - max_df
+            tuple - ngram_range, float - max_df, bool - hashing,
+            int - n_jobs, int - n_features
     OUTPUT: 2d sparse numpy array - X feature matrix,
             vectorizer object - vec
     '''
-    vec = TfidfVectorizer(max_features=max_features,
-                          ngram_range=ngram_range,
-                          max_df=max_df)
-    X = vec.fit_transform(articles)
+    vec = _tfidf_vectorizer(max_features, ngram_range, max_df, hashing,
+                            n_jobs, n_features)
+    X = vec.fit_transform(clean_articles)
     return X, vec
 
 
+def _tfidf_vectorizer(max_features, ngram_range, max_df, hashing=False,
+                      n_jobs=None, n_features=2 ** 18):
+    '''
+    Makes an unfitted TfidfVectorizer, or a HashingTfidf if hashing.
+    '''
+    if hashing:
+        return HashingTfidf(n_features=n_features, ngram_range=ngram_range,
+                            max_df=max_df, n_jobs=n_jobs)
+    return TfidfVectorizer(max_features=max_features,
+                           ngram_range=ngram_range,
+                           max_df=max_df)
+
+
+class HashingTfidf(object):
+    '''
+    TF-IDF built on feature hashing: n-grams are hashed straight into
+        n_features columns, so there is no vocabulary dict to build or
+        pickle, and chunks of documents can be vectorized in parallel
+        (n_jobs processes). The IDF vector is stored separately. A side
+        table maps each hashed column to the most frequent n-gram seen
+        in a sample of the corpus, so topic_parse and concise_topics
+        still show readable terms.
+
+    INPUT:  int - n_features, tuple - ngram_range, float - max_df,
+            int - n_jobs, int - chunk_size, int - term_sample (documents
+            used for the term table)
+    '''
+    def __init__(self, n_features=2 ** 18, ngram_range=(1, 1), max_df=.8,
+                 n_jobs=None, chunk_size=2000, term_sample=5000):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.max_df = max_df
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.term_sample = term_sample
+        self.hasher = HashingVectorizer(n_features=n_features,
+                                        ngram_range=ngram_range,
+                                        alternate_sign=False, norm=None)
+        self.idf_ = None
+        self.terms = {}
+        self._feature_names = None
+
+    def get_params(self, deep=False):
+        '''
+        Vectorizer parameters, for feature_store fingerprints.
+        '''
+        return {'n_features': self.n_features,
+                'ngram_range': self.ngram_range, 'max_df': self.max_df}
+
+    def fit(self, docs):
+        '''
+        Same as fit_transform, but returns the vectorizer.
+        '''
+        self.fit_transform(docs)
+        return self
+
+    def fit_transform(self, docs):
+        '''
+        Learns the IDF weights (dropping columns in more than max_df of
+            the documents) and the term table, and returns X.
+        '''
+        counts = self._hash(docs)
+        n_docs = counts.shape[0]
+        doc_freqs = document_frequencies(counts)
+        self.idf_ = np.log((n_docs + 1.) / (doc_freqs + 1.)) + 1
+        self.idf_[doc_freqs > self.max_df * n_docs] = 0
+        self.terms = self._term_table(docs[:self.term_sample])
+        self._feature_names = None
+        return self._weight(counts)
+
+    def transform(self, docs):
+        '''
+        Vectorizes documents with the fitted IDF weights.
+        '''
+        return self._weight(self._hash(docs))
+
+    def get_feature_names(self):
+        '''
+        Names every column after its term from the side table (or
+            'hash_<column>' for columns never seen in the sample).
+        '''
+        if self._feature_names is None:
+            names = ['hash_%d' % i for i in xrange(self.n_features)]
+            for col, term in self.terms.iteritems():
+                names[col] = term
+            self._feature_names = names
+        return self._feature_names
+
+    def _hash(self, docs):
+        '''
+        Hashes documents into raw term counts, in chunks across n_jobs
+            processes when there is more than one chunk.
+        '''
+        if not self.n_jobs or len(docs) <= self.chunk_size:
+            return self.hasher.transform(docs)
+        n_jobs = cpu_count() if self.n_jobs < 0 else self.n_jobs
+        pool = Pool(n_jobs)
+        try:
+            chunks = pool.map(_hash_chunk,
+                              [(self.hasher, docs[i:i + self.chunk_size])
+                               for i in xrange(0, len(docs),
+                                               self.chunk_size)])
+        finally:
+            pool.close()
+            pool.join()
+        return sp.vstack(chunks).tocsr()
+
+    def _weight(self, counts):
+        '''
+        Applies the IDF weights and l2-normalizes each row.
+        '''
+        return normalize(counts.dot(sp.diags(self.idf_)))
+
+    def _term_table(self, docs):
+        '''
+        Maps hashed columns to the most frequent n-gram hashing there.
+        '''
+        analyze = self.hasher.build_analyzer()
+        term_counts = Counter()
+        for doc in docs:
+            term_counts.update(analyze(doc))
+        terms = [t for t, _ in term_counts.most_common()]
+        hasher = FeatureHasher(n_features=self.n_features,
+                               input_type='string', alternate_sign=False)
+        cols = hasher.transform([[t] for t in terms]).indices
+        table = {}
+        for col, term in zip(cols, terms):
+            table.setdefault(int(col), term)  # most frequent term wins
+        return table
+
+    def __getstate__(self):
+        '''
+        Leaves the cached feature names out of pickles.
+        '''
+        state = self.__dict__.copy()
+        state['_feature_names'] = None
+        return state
+
+
+def _hash_chunk(args):
+    '''
+    Process pool worker: hashes one chunk of documents.
+    '''
+    hasher, docs = args
+    return hasher.transform(docs)
+
+
 def table_tfidf(table, query={}, max_features=5000, ngram_range=(1, 1),
-                max_df=.8):
+                max_df=.8, store_path=None, hashing=False, n_jobs=None,
+                n_features=2 ** 18):
     '''
     Builds a TF-IDF vectorizer using records in the table which match
-        the input query.
+        the input query. Give a store_path to also save X with
+        feature_store.save_features for later steps to reuse. Set
+        hashing to use HashingTfidf with n_features columns (see
+        docs_tfidf).
 
     INPUT:  mongo-collection - table, dict - query, int - max_features,
-            tuple - ngram_range, float - max_df
+            tuple - ngram_range, float - max_df, string - store_path,
+            bool - hashing, int - n_jobs, int - n_features
     OUTPUT: 2d sparse numpy array - X feature matrix,
             vectorizer object - vec,
             list - article_ids corresponding to row indices of matrix
     '''
-    vec = TfidfVectorizer(max_features=max_features,
-                          ngram_range=ngram_range,
-                          max_df=max_df)
+    vec = _tfidf_vectorizer(max_features, ngram_range, max_df, hashing,
+                            n_jobs, n_features)
     q = {'clean_text': {'$exists': True}}
     for k, v in query.iteritems():
         q[k] = v
-    cursor = table.find(q)
-    articles = [(c['_id'], c['clean_text']) for c in cursor]
+    cursor = table.find(q, {'clean_text': 1, 'pub_date': 1})
+    articles = [(c['_id'], c['clean_text'], c['pub_date']) for c in cursor]
     article_ids = [a[0] for a in articles]
     article_text = [a[1] for a in articles]
     X = vec.fit_transform(article_text)
+    if store_path is not None:
+        save_features(store_path, X, article_ids, [a[2] for a in articles],
+                      vec, [len(t.split()) for t in article_text])
     return X, vec, article_ids
 
 
@@ -149,23 +437,214 @@ def basic_nmf(X, n_topics=20, **kwargs):
     return W, H
 
 
+def minibatch_nmf(store, n_topics=20, chunk_size=5000, n_epochs=3,
+                  inner_iter=10, forget=.9, random_state=None,
+                  verbose=False):
+    '''
+    Out-of-core alternative to basic_nmf. Streams X from a FeatureStore
+        in row chunks and updates H online: each chunk is projected onto
+        the current H (fold_in_nmf), its sufficient statistics W'X and
+        W'W are folded into running sums (older chunks decayed by
+        forget), and H takes a few multiplicative update steps. Peak
+        memory is one chunk plus the topics x features statistics.
+    Store rows are sorted by pub_date, so each epoch visits the chunks in
+        a new random order; walking them in date order would decay the
+        earliest years the most and pull H toward recent articles.
+
+    INPUT:  FeatureStore - store, int - n_topics, int - chunk_size,
+            int - n_epochs, int - inner_iter, float - forget,
+            int - random_state, bool - verbose
+    OUTPUT: 2d numpy array - W (Article-Topic matrix),
+            2d numpy array - H (Topic-Term matrix),
+            list - objective (squared reconstruction error summed over
+            each epoch's chunks)
+    '''
+    eps = np.finfo(float).eps
+    rng = np.random.RandomState(random_state)
+    n_features = store.shape[1]
+    X, _, _ = store.rows(0, min(chunk_size, len(store)))
+    scale = np.sqrt(X.sum() / (X.shape[0] * n_features * n_topics))
+    H = scale * rng.rand(n_topics, n_features)
+    A = np.zeros((n_topics, n_features))
+    B = np.zeros((n_topics, n_topics))
+    trace = []
+    starts = np.arange(0, len(store), chunk_size)
+    for epoch in xrange(n_epochs):
+        objective = 0.
+        for start in rng.permutation(starts):
+            X, _, _ = store.rows(start, min(start + chunk_size, len(store)))
+            W = fold_in_nmf(X, H, inner_iter)
+            WtX = np.asarray(X.T.dot(W)).T
+            WtW = W.T.dot(W)
+            objective += (X.multiply(X).sum() - 2 * (WtX * H).sum() +
+                          (WtW * H.dot(H.T)).sum())
+            A = forget * A + WtX
+            B = forget * B + WtW
+            # terms no chunk has had yet keep their random start; the
+            # update would zero them for good
+            seen = A.any(axis=0)
+            for _ in xrange(inner_iter):
+                H[:, seen] *= A[:, seen] / (B.dot(H[:, seen]) + eps)
+        trace.append(objective)
+        if verbose:
+            print 'epoch ', epoch, ' objective ', objective
+    W = np.vstack([fold_in_nmf(X, H) for X, _, _ in
+                   store.iter_chunks(chunk_size)])
+    return W, H, trace
+
+
+def fold_in_nmf(X, H, n_iter=200, tol=1e-4):
+    '''
+    Projects documents onto an existing topic model: solves for a
+        non-negative W minimizing ||X - WH|| with H held fixed, using
+        multiplicative updates. Each iteration only costs
+        (n_docs x n_topics^2), so new documents can be scored without
+        refitting the model.
+
+    INPUT:  2d sparse array - X (new docs, same vectorizer as H),
+            2d numpy array - H, int - n_iter, float - tol
+    OUTPUT: 2d numpy array - W (Article-Topic matrix for the new docs)
+    '''
+    eps = np.finfo(float).eps
+    XHt = np.asarray(X.dot(H.T))
+    HHt = H.dot(H.T)
+    W = np.maximum(XHt.dot(np.linalg.pinv(HHt)), eps)
+    for _ in xrange(n_iter):
+        W_new = W * XHt / (W.dot(HHt) + eps)
+        change = np.abs(W_new - W).sum() / (np.abs(W).sum() + eps)
+        W = W_new
+        if change < tol:
+            break
+    return W
+
+
+def document_frequencies(X):
+    '''
+    Counts the documents containing each feature; keep these (with the
+        number of documents) to update the IDF weights incrementally.
+
+    INPUT:  2d sparse array - X
+    OUTPUT: np array - document count per feature
+    '''
+    X = X.tocsr()
+    return np.bincount(X.indices, minlength=X.shape[1])
+
+
+def update_idf(vec, doc_freqs, n_docs):
+    '''
+    Returns a copy of a fitted TfidfVectorizer with its IDF weights set
+        from stored document frequencies, using the vectorizer's own
+        smoothing rule. The vocabulary stays fixed. vec itself is left
+        alone: feature stores built with it are matched on its
+        fingerprint, which covers the IDF weights.
+
+    INPUT:  vectorizer object - vec, np array - doc_freqs, int - n_docs
+    OUTPUT: vectorizer object - updated copy of vec
+    '''
+    vec = deepcopy(vec)
+    doc_freqs = np.asarray(doc_freqs, dtype=float)
+    if vec.smooth_idf:
+        doc_freqs, n_docs = doc_freqs + 1, n_docs + 1
+    vec.idf_ = np.log(float(n_docs) / doc_freqs) + 1
+    return vec
+
+
+def _reweight_idf(X, vec, old_idf):
+    '''
+    Turns rows vec built with old_idf into rows built with vec's current
+        IDF weights, without vectorizing the documents again.
+    '''
+    scale = np.zeros(len(old_idf))
+    np.divide(vec.idf_, old_idf, out=scale, where=old_idf > 0)
+    X = X.dot(sp.diags(scale)).tocsr()
+    return normalize(X, norm=vec.norm) if vec.norm else X
+
+
+def incremental_topic_update(table, vec, H, query, doc_freqs=None,
+                             n_docs=None, n_iter=200):
+    '''
+    Scores newly scraped articles against an existing model in time
+        proportional to the new articles. The vocabulary stays fixed; if
+        the corpus doc_freqs and n_docs are given, the new articles' counts
+        are added and the IDF weights updated on a copy of vec (returned;
+        vec itself is not changed). The new articles are vectorized once
+        and reweighted for the new IDF. New documents are projected onto
+        H with fold_in_nmf. Refit H with refit_topic_model only when
+        needed.
+
+    INPUT:  mongo-collection - table, vectorizer object - vec,
+            2d numpy array - H, dict - mongo query (the new articles),
+            np array - doc_freqs, int - n_docs, int - n_iter
+    OUTPUT: 2d numpy array - W, list - article_ids,
+            np array - updated doc_freqs, int - updated n_docs,
+            vectorizer object - vec (the updated copy, or vec itself)
+    '''
+    q = {'clean_text': {'$exists': True, '$ne': ''}}
+    q.update(query)
+    cursor = table.find(q, {'clean_text': 1})
+    articles = [(c['_id'], c['clean_text']) for c in cursor]
+    article_ids = [a[0] for a in articles]
+    X = vec.transform([a[1] for a in articles])
+    if doc_freqs is not None:
+        doc_freqs = doc_freqs + document_frequencies(X)
+        n_docs += len(articles)
+        old_idf = vec.idf_
+        vec = update_idf(vec, doc_freqs, n_docs)
+        X = _reweight_idf(X, vec, old_idf)
+    W = fold_in_nmf(X, H, n_iter)
+    return W, article_ids, doc_freqs, n_docs, vec
+
+
+def refit_topic_model(X, W, H, max_iter=200):
+    '''
+    Refits the topic model on the full corpus, warm-started from the
+        current W and H so it converges in fewer iterations than a fresh
+        basic_nmf.
+
+    INPUT:  2d sparse array - X (full corpus), 2d numpy array - W,
+            2d numpy array - H, int - max_iter
+    OUTPUT: 2d numpy array - W, 2d numpy array - H
+    '''
+    nmf = NMF(n_components=H.shape[0], init='custom', max_iter=max_iter)
+    W = nmf.fit_transform(X, W=np.array(W, order='C'),
+                          H=np.array(H, order='C'))
+    return W, nmf.components_
+
+
 def topic_parse(vec, H, n_top_words=20):
     '''
     Connects actual terms and n-grams to the features of each topic
-        for visualization.
+        for visualization. Each topic keeps its n_top_words - 1 strongest
+        terms, so n_top_words <= 1 gives empty dicts.
 
     INPUT:  vectorizer object - vec, 2d numpy array - H, int - n_top_words
     OUTPUT: dict - topics_dicts (most important terms for each topic)
     '''
     topics_dicts = []
-    n_topics = H.shape[0]
-
-    for i in xrange(n_topics):
-        k, v = zip(*sorted(zip(vec.get_feature_names(), H[i]),
-                           key=lambda x: x[1])[:-n_top_words:-1])
-        val_arr = np.array(v)
+    names = vec.get_feature_names()
+    H = np.asarray(H)
+    n = min(n_top_words - 1, H.shape[1])
+    if n <= 0:
+        return [{} for _ in xrange(H.shape[0])]
+
+    # n largest per row; ties go to the highest column index, as a stable
+    # ascending sort read backwards would pick them
+    top = np.argpartition(H, -n, axis=1)[:, -n:]
+    rows = np.arange(H.shape[0])[:, np.newaxis]
+    cutoff = H[rows, top].min(axis=1)[:, np.newaxis]
+    tied = np.flatnonzero((H == cutoff).sum(axis=1) >
+                          n - (H > cutoff).sum(axis=1))
+    for i in tied:
+        above = np.flatnonzero(H[i] > cutoff[i])
+        ties = np.flatnonzero(H[i] == cutoff[i])[::-1][:n - len(above)]
+        top[i] = np.r_[above, ties]
+
+    for i, cols in enumerate(top):
+        vals = H[i, cols]
+        order = np.lexsort((cols, vals))[::-1]
+        cols, val_arr = cols[order], vals[order]
         norms = val_arr / np.sum(val_arr)
-        topics_dicts.append(dict(zip(k, norms * 100)))
+        topics_dicts.append(dict(zip([names[c] for c in cols], norms * 100)))
     return topics_dicts
 
 
@@ -232,7 +711,7 @@ def final_topic_pipeline(table, query, article_relevance, relevance_threshold,
     q = {'clean_text': {'$exists': True}}
     for k, v in query.iteritems():
         q[k] = v
-    cursor = table.find(q)
+    cursor = table.find(q, {'clean_text': 1})
     query_df = pd.DataFrame([(c['_id'], c['clean_text']) for c in cursor])
     query_df.columns = ['_id', 'clean_text']
 
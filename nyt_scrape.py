@@ -9,10 +9,17 @@ page: int (10 results per page)
 notes: make sure mongod is up and running. use `sudo mongod` in terminal
 '''
 import requests
-from pymongo import MongoClient
+import threading
+import Queue
+from urllib import urlencode
+from urlparse import urlparse, urlunparse, parse_qsl
+from requests.adapters import HTTPAdapter
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from bs4 import BeautifulSoup
 import simplejson as json
-from time import sleep
+from time import sleep, time
+from datetime import datetime, timedelta
 
 BASE_URL = 'http://api.nytimes.com/svc/search/v2/articlesearch.json?'
 with open('nytapi.txt') as f:
@@ -24,6 +31,48 @@ URLS_TO_IGNORE = set(['http://www.nytimes.com/video', 'http://www.legacy.com',
                       'http://cooking.nytimes.com/recipes',
                       'http://www.nytimes.com/interactive'])
 
+# full text scraping concurrency defaults
+SCRAPE_WORKERS = 8
+SCRAPE_PER_HOST = 4
+SCRAPE_TIMEOUT = 30
+
+# article search API paging and rate limits
+API_PAGE_LIMIT = 100  # the API refuses pages past this
+API_RATE = 10  # requests per second
+API_WORKERS = 4
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+
+
+class RateLimiter(object):
+    '''
+    Token-bucket rate limiter which can be shared between threads. Refills
+        at rate tokens per second and holds at most burst tokens.
+
+    INPUT:  float - rate, int - burst
+    '''
+    def __init__(self, rate=API_RATE, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a token is available, then spends it.
+        '''
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
 
 def mongo_connection():
     '''
@@ -71,18 +120,63 @@ def single_query(url):
     return docs
 
 
-def count_query(url):
+def _page_url(url, page):
+    '''
+    Sets the page parameter of an API url, replacing any existing one.
+
+    INPUT:  string - url, int - page
+    OUTPUT: string - url
+    '''
+    parts = urlparse(url)
+    params = [(k, v) for k, v in parse_qsl(parts.query) if k != 'page']
+    params.append(('page', str(page)))
+    return urlunparse(parts._replace(query=urlencode(params)))
+
+
+def _get_with_retry(url, session=None, limiter=None, max_retries=5,
+                    backoff=1.):
+    '''
+    Makes a request, retrying rate-limited (429), server error (5xx) and
+        connection failures with exponential backoff. Waits on the
+        limiter before every attempt.
+
+    INPUT:  string - url, requests.Session - session,
+            RateLimiter - limiter, int - max_retries, float - backoff seconds
+    OUTPUT: requests.Response - response OR None - every attempt failed
+    '''
+    getter = session if session is not None else requests
+    response = None
+    for attempt in xrange(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = getter.get(url, timeout=SCRAPE_TIMEOUT)
+        except requests.RequestException:
+            response = None
+        if response is not None and \
+                response.status_code not in RETRY_STATUSES:
+            return response
+        if attempt < max_retries:
+            sleep(backoff * 2 ** attempt)
+    return response
+
+
+def count_query(url, session=None, limiter=None):
     '''
     Makes a request to the NYT API and returns the count of docs that
-        match the query.
+        match the query. Given a limiter, waits on it and retries
+        rate-limited requests.
 
-    INPUT:  string - url
+    INPUT:  string - url, requests.Session - session, RateLimiter - limiter
     OUTPUT: int - number of hits OR None - request failed
     '''
-    response = requests.get(url)
-    if response.status_code == 200:
+    if limiter is not None:
+        response = _get_with_retry(url, session, limiter)
+    else:
+        response = requests.get(url)
+    if response is not None and response.status_code == 200:
         return response.json()['response']['meta']['hits']
-    print 'Request Failed', response_status_code
+    print 'Request Failed', getattr(response, 'status_code', None)
     return None
 
 
@@ -118,9 +212,7 @@ def many_queries(q=None, param_dict=None, max_pages=10, url=None):
     present_date = date_process(docs[-1]['pub_date'])
     for p in range(1, min(max_pages, n+1)):
         # add the page number to the query, make it again
-        new_url = url.split('api-key')
-        new_url[0] += 'page=' + str(p) + '&'
-        new_url = 'api-key'.join(new_url)
+        new_url = _page_url(url, p)
         try:  # don't lose the docs we already have if if borks
             new_docs = single_query(new_url)
             if new_docs is not None:
@@ -136,42 +228,389 @@ def many_queries(q=None, param_dict=None, max_pages=10, url=None):
     return docs, present_date
 
 
+def paginate_query(q=None, param_dict=None, max_pages=API_PAGE_LIMIT,
+                   url=None, start_page=0, n_workers=API_WORKERS,
+                   limiter=None, session=None, report=None, verbose=False):
+    '''
+    Streams every document of a query from the NYT API. The first page
+        reveals meta.hits, which fixes the page plan; the remaining pages
+        are fetched concurrently by n_workers threads under a shared
+        token-bucket limiter, retrying 429/5xx responses with backoff.
+        Pages that still fail get one more pass once the rest are done.
+        Docs are yielded as pages arrive (not in page order), so the
+        stream can be fed straight into load_mongo.
+
+    If report is a dict it is filled with 'hits', 'pages', 'failed_pages'
+        and 'last_good_page'; restart an interrupted query with
+        start_page=report['last_good_page'] + 1.
+
+    INPUT:  string - q, dict - param_dict, int - max_pages
+            OR (if your API url is already built) string - url,
+            int - start_page, int - n_workers, RateLimiter - limiter,
+            requests.Session - session, dict - report, bool - verbose
+    OUTPUT: generator - document record dicts
+    '''
+    if not url:
+        url = _query_url(q, param_dict or {})
+    if limiter is None:
+        limiter = RateLimiter()
+    if session is None:
+        session = http_session(n_workers)
+    if report is None:
+        report = {}
+    report.update({'hits': None, 'pages': 0, 'failed_pages': [],
+                   'last_good_page': start_page - 1})
+
+    response = _get_with_retry(_page_url(url, start_page), session, limiter)
+    if response is None or response.status_code != 200:
+        print 'query failed on page ', start_page
+        report['failed_pages'] = [start_page]
+        return
+    d = response.json()
+    hits = d['response']['meta']['hits']
+    n_pages = min(max_pages, (hits + 9) / 10)
+    report['hits'] = hits
+    report['pages'] = n_pages
+    if verbose:
+        print 'Found ', hits, ' hits, fetching ', n_pages, ' pages'
+    for doc in d['response']['docs']:
+        yield doc
+
+    good = set([start_page])
+    pages = range(start_page + 1, n_pages)
+    for attempt in range(2):  # second pass retries the failed pages
+        failed = []
+        for page, docs in _fetch_pages(url, pages, n_workers, limiter,
+                                       session):
+            if docs is None:
+                failed.append(page)
+                continue
+            good.add(page)
+            for doc in docs:
+                yield doc
+        pages = sorted(failed)
+        if not pages:
+            break
+        if verbose:
+            print 'retrying ', len(pages), ' failed pages'
+
+    report['failed_pages'] = pages
+    last_good = start_page - 1
+    while last_good + 1 in good:
+        last_good += 1
+    report['last_good_page'] = last_good
+    if pages:
+        print 'pages failed: ', pages, ' last good page: ', last_good
+
+
+def _fetch_pages(url, pages, n_workers, limiter, session):
+    '''
+    Fetches the given pages of an API query with a pool of threads.
+
+    INPUT:  string - url, list - page numbers, int - n_workers,
+            RateLimiter - limiter, requests.Session - session
+    OUTPUT: generator - (page, list of docs OR None if failed) tuples
+    '''
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    for p in pages:
+        tasks.put(p)
+
+    def work():
+        while True:
+            try:
+                p = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            response = _get_with_retry(_page_url(url, p), session, limiter)
+            try:
+                docs = response.json()['response']['docs']
+            except:  # no response, bad status or mangled json
+                docs = None
+            results.put((p, docs))
+
+    threads = [threading.Thread(target=work)
+               for _ in xrange(min(n_workers, len(pages)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for _ in pages:
+        yield results.get()
+
+
+def plan_date_windows(q, begin_date, end_date, param_dict=None,
+                      max_hits=API_PAGE_LIMIT * 10, limiter=None,
+                      session=None, verbose=False):
+    '''
+    Splits [begin_date, end_date] into consecutive date windows whose hits
+        all fit within the pages the API will serve. Uses count_query and
+        recursive bisection: a window with too many hits is split in half,
+        and only the left half is counted again (the right half gets the
+        rest). Windows with no hits are dropped; a single day that still
+        exceeds max_hits is kept as is.
+
+    INPUT:  string - q, string - begin_date, string - end_date (yyyymmdd),
+            dict - param_dict (other query parameters), int - max_hits,
+            RateLimiter - limiter, requests.Session - session,
+            bool - verbose
+    OUTPUT: list - (begin_date, end_date, hits) tuples in date order
+    '''
+    if limiter is None:
+        limiter = RateLimiter()
+    params = dict(param_dict or {})
+
+    def count(begin, end):
+        params['begin_date'] = begin.strftime('%Y%m%d')
+        params['end_date'] = end.strftime('%Y%m%d')
+        return count_query(_query_url(q, params), session, limiter)
+
+    def bisect(begin, end, hits):
+        if hits == 0:
+            return []
+        if hits <= max_hits or begin == end:
+            if hits > max_hits:
+                print 'too many hits to page through on ', begin.date()
+            return [(begin.strftime('%Y%m%d'), end.strftime('%Y%m%d'),
+                     hits)]
+        mid = begin + timedelta(days=(end - begin).days / 2)
+        after = mid + timedelta(days=1)
+        left_hits = count(begin, mid)
+        if left_hits is None:
+            raise IOError('count query failed between %s and %s'
+                          % (begin.date(), mid.date()))
+        # hits can grow between requests while the index updates
+        right_hits = max(hits - left_hits, 0)
+        if verbose:
+            print begin.date(), mid.date(), left_hits, '|', \
+                after.date(), end.date(), right_hits
+        return bisect(begin, mid, left_hits) + bisect(after, end, right_hits)
+
+    begin = datetime.strptime(begin_date, '%Y%m%d')
+    end = datetime.strptime(end_date, '%Y%m%d')
+    hits = count(begin, end)
+    if hits is None:
+        raise IOError('count query failed')
+    return bisect(begin, end, hits)
+
+
+def scrape_date_windows(q, windows, param_dict=None, n_workers=API_WORKERS,
+                        limiter=None, session=None, reports=None,
+                        verbose=False):
+    '''
+    Scrapes every window from plan_date_windows in parallel, one
+        paginate_query per window, all sharing a single rate limiter and
+        session. Yields docs as they arrive, so it can feed load_mongo.
+
+    If reports is a list, a (window, paginate_query report) tuple is
+        appended to it for every window, for resuming failed pages.
+
+    INPUT:  string - q, list - (begin_date, end_date, hits) windows,
+            dict - param_dict, int - n_workers (windows in flight),
+            RateLimiter - limiter, requests.Session - session,
+            list - reports, bool - verbose
+    OUTPUT: generator - document record dicts
+    '''
+    if limiter is None:
+        limiter = RateLimiter()
+    if session is None:
+        session = http_session(n_workers)
+    if reports is None:
+        reports = []
+    tasks = Queue.Queue()
+    results = Queue.Queue(maxsize=1000)
+    done = object()
+    for w in windows:
+        tasks.put(w)
+
+    def work():
+        while True:
+            try:
+                w = tasks.get_nowait()
+            except Queue.Empty:
+                results.put(done)
+                return
+            params = dict(param_dict or {})
+            params['begin_date'], params['end_date'] = w[0], w[1]
+            report = {}
+            try:
+                for doc in paginate_query(q, params, n_workers=1,
+                                          limiter=limiter, session=session,
+                                          report=report):
+                    results.put(doc)
+            except:
+                print 'window failed: ', w[0], ' > ', w[1]
+            reports.append((w, report))
+            if verbose:
+                print 'finished window ', w[0], ' > ', w[1], ': ', \
+                    w[2], ' hits'
+
+    n_threads = min(n_workers, len(windows))
+    for _ in xrange(n_threads):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+    finished = 0
+    while finished < n_threads:
+        doc = results.get()
+        if doc is done:
+            finished += 1
+        else:
+            yield doc
+
+
 def load_mongo(table, docs):
     '''
-    Adds new documents to the database.
+    Adds new documents to the database. Accepts any iterable of docs,
+        such as the stream from paginate_query.
 
-    INPUT:  mongo-collection - table, list - document records
+    INPUT:  mongo-collection - table, iterable - document records
     OUTPUT: set - ids of docs already in the table
     '''
     # load new documents into mongo table, checking for existence using _id
     ignore_ids = set()
     for d in docs:
-        if table.find_one({'web_url': d['web_url']}) is None:
+        if table.find_one({'web_url': d['web_url']}, {'_id': 1}) is None:
             d['full_text'] = ''
             table.update({'_id': d['_id']}, d, upsert=True)
         else:
             ignore_ids.add(d['_id'])
     return ignore_ids
 
-def get_full_text(web_url):
+
+def ensure_web_url_index(table):
+    '''
+    Creates the unique web_url index that load_mongo_bulk relies on (a
+        no-op if it already exists). Fails if the table already holds
+        duplicate web_urls.
+
+    INPUT:  mongo-collection - table
+    OUTPUT: string - index name
+    '''
+    return table.create_index('web_url', unique=True)
+
+
+def load_mongo_bulk(table, docs, batch_size=1000, verbose=False,
+                    report=None):
+    '''
+    Adds new documents to the database like load_mongo, but with unordered
+        bulk_write batches of upserts keyed on the unique web_url index.
+        $setOnInsert leaves docs already in the table untouched.
+    If report is a dict it is filled with the 'inserted' and 'skipped'
+        counts from the bulk results; verbose also prints them.
+
+    INPUT:  mongo-collection - table, iterable - document records,
+            int - batch_size, bool - verbose, dict - report
+    OUTPUT: set - ids of docs already in the table
+    '''
+    ensure_web_url_index(table)
+    if report is None:
+        report = {}
+    ignore_ids = set()
+    inserted = 0
+    skipped = 0
+    batch = []
+    for d in docs:
+        batch.append(d)
+        if len(batch) == batch_size:
+            n = _bulk_upsert(table, batch, ignore_ids)
+            inserted += n
+            skipped += len(batch) - n
+            batch = []
+    if batch:
+        n = _bulk_upsert(table, batch, ignore_ids)
+        inserted += n
+        skipped += len(batch) - n
+    report.update({'inserted': inserted, 'skipped': skipped})
+    if verbose:
+        print 'inserted ', inserted, ' docs, skipped ', skipped
+    return ignore_ids
+
+
+def _bulk_upsert(table, docs, ignore_ids):
+    '''
+    Upserts one batch of docs, adding the ids of docs that were not
+        inserted to ignore_ids. Duplicate key errors (a web_url or _id
+        that is already taken) count as skipped docs. Inserted docs are
+        matched by the _ids the server reports upserting (each doc's own
+        _id, via $setOnInsert), not by op position.
+
+    INPUT:  mongo-collection - table, list - document records,
+            set - ignore_ids
+    OUTPUT: int - number of docs inserted
+    '''
+    ops = []
+    for d in docs:
+        new = {k: v for k, v in d.iteritems() if k != 'web_url'}
+        new['full_text'] = ''
+        ops.append(UpdateOne({'web_url': d['web_url']},
+                             {'$setOnInsert': new}, upsert=True))
+    try:
+        upserted = table.bulk_write(ops, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        if any(err['code'] != 11000 for err in e.details['writeErrors']):
+            raise
+        upserted = {u['index']: u['_id'] for u in e.details['upserted']}
+    new_ids = set(upserted.values())
+    inserted = 0
+    for d in docs:
+        if d['_id'] in new_ids:
+            new_ids.discard(d['_id'])  # a repeated doc was skipped
+            inserted += 1
+        else:
+            ignore_ids.add(d['_id'])
+    return inserted
+
+
+def http_session(pool_size=SCRAPE_WORKERS):
+    '''
+    Creates a requests session whose connection pool keeps up to pool_size
+        keep-alive connections per host, so repeated requests skip the
+        TCP/HTTP handshake.
+
+    INPUT:  int - pool_size
+    OUTPUT: requests.Session - session
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_full_text(web_url, session=None, timeout=None):
     '''
     Scrapes the full article text from a single web_url. Designed to
         handle a variety of html article styles that the NYT website
-        has used over time.
+        has used over time. Pass a session to reuse pooled connections.
 
-    INPUT:  string - web_url
+    INPUT:  string - web_url, requests.Session - session, float - timeout
     OUTPUT: string - full article text (or '' if no article exists)
     '''
+    getter = session if session is not None else requests
     try:
-        r = requests.get(web_url)
+        r = getter.get(web_url, timeout=timeout)
         if r.status_code != 200:
             print 'error: status code ', r.status_code
             return ''
-        s = BeautifulSoup(r.text, 'html.parser')
+        story = _parse_article_html(r.text)
     except:
         print 'requests error with url: ', web_url
         return ''
 
+    if story == '':
+        print 'bad scrape. web_url: ', web_url
+    return story
+
+
+def _parse_article_html(html):
+    '''
+    Pulls the article text out of an NYT article page.
+
+    INPUT:  string - html
+    OUTPUT: string - full article text (or '' if no article exists)
+    '''
+    s = BeautifulSoup(html, 'html.parser')
+
     # Deal with the different formattings of articles in HTML
     if s.find('p', {'itemprop': 'articleBody'}) is not None:
         paragraphs = s.findAll('p', {'itemprop': 'articleBody'})
@@ -187,25 +626,121 @@ def get_full_text(web_url):
             story = ' '.join([p.text for p in paragraphs])
         else:
             story = ''
-
-    if story == '':
-        print 'bad scrape. web_url: ', web_url
     return story
 
 
-def load_full_texts(table, verbose=False):
+def _ignored_url(web_url):
+    '''
+    Checks whether web_url starts with one of the URLS_TO_IGNORE snippets.
+
+    INPUT:  string - web_url
+    OUTPUT: bool
+    '''
+    return any(web_url.startswith(u) for u in URLS_TO_IGNORE)
+
+
+def scrape_full_texts(table, records, n_workers=SCRAPE_WORKERS,
+                      per_host=SCRAPE_PER_HOST, max_requests=None,
+                      session=None, verbose=False):
+    '''
+    Concurrently scrapes full article texts for the given records. A pool
+        of n_workers threads shares one keep-alive session, at most
+        per_host requests are in flight to any single host, and at most
+        max_requests urls are fetched in total (None for no budget).
+        Each result is written to the table as soon as it arrives.
+
+    INPUT:  mongo-collection - table, iterable - records (dicts with _id
+            and web_url), int - n_workers, int - per_host,
+            int - max_requests, requests.Session - session, bool - verbose
+    OUTPUT: tuple - (int - articles scraped, int - failed scrapes)
+    '''
+    if session is None:
+        session = http_session(max(n_workers, per_host))
+    tasks = Queue.Queue(maxsize=n_workers * 2)
+    results = Queue.Queue()
+    host_limits = {}
+    host_lock = threading.Lock()
+    done = object()
+
+    def host_semaphore(web_url):
+        host = urlparse(web_url).netloc
+        with host_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.Semaphore(per_host)
+            return host_limits[host]
+
+    def feed():
+        n = 0
+        try:
+            for record in records:
+                if max_requests is not None and n >= max_requests:
+                    break
+                if _ignored_url(record['web_url']):
+                    results.put((record['_id'], ''))
+                    continue
+                tasks.put(record)
+                n += 1
+        finally:  # always release the workers
+            for _ in xrange(n_workers):
+                tasks.put(done)
+
+    def work():
+        while True:
+            record = tasks.get()
+            if record is done:
+                results.put(done)
+                return
+            with host_semaphore(record['web_url']):
+                story = get_full_text(record['web_url'], session,
+                                      SCRAPE_TIMEOUT)
+            results.put((record['_id'], story))
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work) for _ in xrange(n_workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    scraped, failed, finished = 0, 0, 0
+    while finished < n_workers:
+        result = results.get()
+        if result is done:
+            finished += 1
+            continue
+        _id, story = result
+        if story != '':
+            scraped += 1
+            table.update({'_id': _id}, {'$set': {'full_text': story}},
+                         upsert=True)
+        else:
+            failed += 1
+            table.update({'_id': _id}, {'$set': {'failed_scrape': True}})
+        if verbose and (scraped + failed) % 50 == 0:
+            print 'scraped ', scraped, ' articles, ', failed, ' failed'
+    return scraped, failed
+
+
+def load_full_texts(table, verbose=False, n_workers=None, **kwargs):
     '''
     Attempts to scrape full article text for every article in the table
         which currently lacks it. Use of load_full_texts_from_docs
-        in real time during a scrape is preferred.
+        in real time during a scrape is preferred. Set n_workers to
+        scrape concurrently with scrape_full_texts.
 
-    INPUT:  mongo-collection - table, bool - verbose
+    INPUT:  mongo-collection - table, bool - verbose, int - n_workers,
+            **kwargs for scrape_full_texts
     OUTPUT: None
     '''
-    for record in table.find({'document_type': 'article',
-                              'full_text': '',
-                              'type_of_material': 'News',
-                              'failed_scrape': {'$exists':False}}):
+    query = {'document_type': 'article',
+             'full_text': '',
+             'type_of_material': 'News',
+             'failed_scrape': {'$exists':False}}
+    if n_workers:
+        records = table.find(query, {'web_url': 1})
+        scrape_full_texts(table, records, n_workers=n_workers,
+                          verbose=verbose, **kwargs)
+        return
+    for record in table.find(query, {'web_url': 1}):
         story = get_full_text(record['web_url'])
         if verbose:
             print story[:100]
@@ -218,17 +753,26 @@ def load_full_texts(table, verbose=False):
                          {'$set': {'failed_scrape': True}})
 
 
-def load_full_texts_from_docs(table, docs, verbose=False):
+def load_full_texts_from_docs(table, docs, verbose=False, n_workers=None,
+                              **kwargs):
     '''
     Attempts to scrape full article texts for every article in the
         given list of docs. Generally used immediately after the API
-        returns these docs.
+        returns these docs. Set n_workers to scrape concurrently with
+        scrape_full_texts.
 
-    INPUT:  mongo-collection - table, list - docs, bool - verbose
+    INPUT:  mongo-collection - table, list - docs, bool - verbose,
+            int - n_workers, **kwargs for scrape_full_texts
     OUTPUT: None
     '''
+    if n_workers:
+        urls = [d['web_url'] for d in docs]
+        records = table.find({'web_url': {'$in': urls}}, {'web_url': 1})
+        scrape_full_texts(table, records, n_workers=n_workers,
+                          verbose=verbose, **kwargs)
+        return
     for i, d in enumerate(docs):
-        if table.find_one({'web_url': d['web_url']}) is not None:
+        if table.find_one({'web_url': d['web_url']}, {'_id': 1}) is not None:
             story = get_full_text(d['web_url'])
             if verbose and i % 50 == 0:
                 print 'doc ', i, ': ', story[:100]
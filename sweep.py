@@ -0,0 +1,194 @@
+'''
+Hyperparameter sweeps for the Always Remember topic pipeline. Runs
+    TF-IDF->NMF over a grid of n_topics, max_features, max_df and
+    ngram_range, and saves reconstruction error, topic coherence and
+    wall time for each run to a results CSV.
+
+usage: results = run_sweep(table, query, sweep_grid(n_topics=[50, 100]))
+'''
+import itertools
+import os
+from multiprocessing import Pool, cpu_count
+from time import time
+import numpy as np
+import pandas as pd
+from nlp import docs_tfidf, basic_nmf
+
+VECTORIZER_PARAMS = ['max_features', 'max_df', 'ngram_range']
+RESULT_COLUMNS = ['n_topics', 'max_features', 'max_df', 'ngram_range',
+                  'reconstruction_err', 'coherence', 'vectorize_seconds',
+                  'nmf_seconds']
+
+
+def sweep_grid(n_topics=(30,), max_features=(20000,), max_df=(.8,),
+               ngram_range=((1, 3),)):
+    '''
+    Builds every combination of the given parameter values. The defaults
+        match initial_topic_pipeline.
+
+    INPUT:  list - n_topics, list - max_features, list - max_df,
+            list - ngram_range tuples
+    OUTPUT: list - config dicts
+    '''
+    return [{'n_topics': t, 'max_features': f, 'max_df': d,
+             'ngram_range': tuple(n)}
+            for t, f, d, n in itertools.product(n_topics, max_features,
+                                                max_df, ngram_range)]
+
+
+def run_sweep(table, query, grid, results_csv='sweep_results.csv',
+              n_jobs=-1, n_top_words=10, verbose=False, **nmf_kwargs):
+    '''
+    Fits a topic model for each config in grid and appends one row per run
+        to results_csv as soon as it finishes. Configs already in
+        results_csv are skipped, so an interrupted or extended sweep only
+        runs what's missing; use one results_csv per query.
+    The corpus is read from mongo once and vectorized once per distinct
+        (max_features, max_df, ngram_range); the NMF fits for each
+        vectorizer run in a pool of n_jobs processes (-1 for all cores).
+    Coherence is the mean UMass coherence of each topic's n_top_words.
+
+    INPUT:  mongo-collection - table, dict - mongo query, list - configs
+            (see sweep_grid), string - results_csv, int - n_jobs,
+            int - n_top_words, boolean - verbose, **kwargs for NMF
+    OUTPUT: DataFrame - all results in results_csv
+    '''
+    done = set()
+    if os.path.exists(results_csv):
+        done = set(_run_key(r) for _, r in
+                   pd.read_csv(results_csv).iterrows())
+    todo = [c for c in grid if _run_key(c) not in done]
+    if verbose:
+        print len(grid) - len(todo), ' runs cached, ', len(todo), ' to go'
+    if not todo:
+        return pd.read_csv(results_csv)
+
+    q = {'clean_text': {'$exists': True}}
+    q.update(query)
+    texts = [c['clean_text'] for c in table.find(q, {'clean_text': 1})]
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    nmf_kwargs.setdefault('random_state', 0)
+
+    for vec_key, configs in itertools.groupby(
+            sorted(todo, key=_vectorizer_key), key=_vectorizer_key):
+        vec_params = dict(zip(VECTORIZER_PARAMS, vec_key))
+        t0 = time()
+        X, _ = docs_tfidf(texts, **vec_params)
+        vec_secs = time() - t0
+        if verbose:
+            print 'vectorized ', vec_params, ' in %.1fs' % vec_secs
+        topic_counts = [c['n_topics'] for c in configs]
+        pool = Pool(min(n_jobs, len(topic_counts)), initializer=_init_sweep,
+                    initargs=(X, n_top_words, nmf_kwargs))
+        try:
+            for n_topics, err, coherence, secs in pool.imap_unordered(
+                    _sweep_fit, topic_counts):
+                row = dict(vec_params, n_topics=n_topics,
+                           reconstruction_err=err, coherence=coherence,
+                           vectorize_seconds=vec_secs, nmf_seconds=secs)
+                _append_result(results_csv, row)
+                if verbose:
+                    print 'n_topics=%d: error %.4f, coherence %.4f, %.1fs' % (
+                        n_topics, err, coherence, secs)
+        finally:
+            pool.close()
+            pool.join()
+    return pd.read_csv(results_csv)
+
+
+def reconstruction_error(X, W, H):
+    '''
+    Frobenius norm of X - WH (NMF's reconstruction_err_), computed without
+        densifying X.
+
+    INPUT:  2d sparse array - X, 2d numpy array - W, 2d numpy array - H
+    OUTPUT: float - error
+    '''
+    sq = (X.multiply(X).sum() - 2 * (X.dot(H.T) * W).sum() +
+          (W.T.dot(W) * H.dot(H.T)).sum())
+    return np.sqrt(max(sq, 0))
+
+
+def umass_coherence(X, H, n_top_words=10):
+    '''
+    UMass coherence of each topic: sum over pairs of its top words of
+        log((D(w_i, w_j) + 1) / D(w_j)), where D counts the documents of X
+        containing the words and w_j outranks w_i. Closer to 0 is more
+        coherent.
+
+    INPUT:  2d sparse array - X, 2d numpy array - H, int - n_top_words
+    OUTPUT: numpy array - coherence per topic
+    '''
+    n = min(n_top_words, H.shape[1])
+    top = np.argpartition(-H, n - 1, axis=1)[:, :n]
+    rows = np.arange(H.shape[0])[:, np.newaxis]
+    top = top[rows, np.argsort(-H[rows, top], axis=1)]
+    present = (X[:, np.unique(top)] > 0).astype(float)
+    codocs = present.T.dot(present).toarray()
+    col = dict((w, i) for i, w in enumerate(np.unique(top)))
+    later, earlier = np.tril_indices(n, -1)
+    scores = np.empty(H.shape[0])
+    for t, words in enumerate(top):
+        c = np.array([col[w] for w in words])
+        pairs = codocs[c[later], c[earlier]]
+        df = np.maximum(codocs[c[earlier], c[earlier]], 1)
+        scores[t] = np.log((pairs + 1) / df).sum()
+    return scores
+
+
+_SWEEP = None
+
+
+def _init_sweep(X, n_top_words, nmf_kwargs):
+    '''
+    Process pool initializer: keeps the feature matrix in each worker so
+        fits don't have to ship it.
+    '''
+    global _SWEEP
+    _SWEEP = (X, n_top_words, nmf_kwargs)
+
+
+def _sweep_fit(n_topics):
+    '''
+    Process pool worker: fits one NMF on the worker's feature matrix.
+
+    INPUT:  int - n_topics
+    OUTPUT: tuple - (int - n_topics, float - reconstruction error,
+            float - mean coherence, float - seconds)
+    '''
+    X, n_top_words, nmf_kwargs = _SWEEP
+    t0 = time()
+    W, H = basic_nmf(X, n_topics, **nmf_kwargs)
+    secs = time() - t0
+    return (n_topics, reconstruction_error(X, W, H),
+            umass_coherence(X, H, n_top_words).mean(), secs)
+
+
+def _vectorizer_key(config):
+    '''
+    The vectorizer parameters of a config, for grouping runs.
+    '''
+    return tuple(config[p] for p in VECTORIZER_PARAMS)
+
+
+def _run_key(config):
+    '''
+    Identifies a run, whether config is a grid dict or a row read back
+        from the results CSV (where ngram_range is a string).
+    '''
+    ngrams = config['ngram_range']
+    if isinstance(ngrams, basestring):
+        ngrams = tuple(int(n) for n in ngrams.strip('()').split(','))
+    return (int(config['n_topics']), int(config['max_features']),
+            float(config['max_df']), tuple(ngrams))
+
+
+def _append_result(results_csv, row):
+    '''
+    Appends one run to the results CSV, writing the header if it's new.
+    '''
+    row = dict(row, ngram_range=str(tuple(row['ngram_range'])))
+    new = not os.path.exists(results_csv)
+    pd.DataFrame([row], columns=RESULT_COLUMNS).to_csv(
+        results_csv, mode='a', header=new, index=False)
@@ -0,0 +1,41 @@
+'''
+Shared fixtures for the Always Remember tests. Mongo tests run against
+    mongomock, or against a real mongod (MONGO_URI, default localhost)
+    when they need server behaviour; those skip if no mongod is up.
+'''
+import os
+import sys
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+@pytest.fixture
+def mock_table():
+    '''
+    A fresh mongomock collection.
+    '''
+    mongomock = pytest.importorskip('mongomock')
+    return mongomock.MongoClient().always_remember_test.articles
+
+
+@pytest.fixture
+def mongod_table():
+    '''
+    A fresh collection on a real mongod, dropped afterwards.
+    '''
+    client = MongoClient(os.environ.get('MONGO_URI',
+                                        'mongodb://localhost:27017'),
+                         serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except ConnectionFailure:
+        pytest.skip('no mongod running')
+    table = client.always_remember_test.articles
+    table.drop()
+    yield table
+    table.drop()
+    client.close()
@@ -0,0 +1,528 @@
+'''
+Tests for analysis: topic scoring, aggregation and article selection.
+'''
+import pickle
+import json
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import TfidfVectorizer
+import analysis
+from feature_store import cache_topic_weights, decode_topic_weights, \
+    save_features, save_model_artifacts, vectorizer_fingerprint, TopicCube, \
+    TopicWeightStore
+from nlp import HashingTfidf
+
+WORDS = ('towers rescue firefighters memorial fund victims families '
+         'anthrax letters senate afghanistan taliban troops kabul '
+         'airport security screening airline budget mayor').split()
+
+
+@pytest.fixture
+def corpus(mock_table):
+    '''
+    Fills mock_table with 120 random articles over the first half of 2002
+        and returns a TopicAnalyzer with 4 topics fitted on them.
+    '''
+    rng = np.random.RandomState(0)
+    records = []
+    for i in xrange(120):
+        words = rng.choice(WORDS[6 * (i % 3):6 * (i % 3) + 8],
+                           rng.randint(3, 30))
+        day = date(2002, 1, 1).toordinal() + rng.randint(181)
+        records.append({'_id': 'c%03d' % i, 'clean_text': ' '.join(words),
+                        'pub_date': date.fromordinal(day).isoformat() +
+                        'T%02d:00:00Z' % rng.randint(24),
+                        'type_of_material': 'News' if i % 10 else 'Op-Ed',
+                        'headline': {'main': 'Headline %d' % i},
+                        'lead_paragraph': 'Lead paragraph %d.' % i,
+                        'web_url': 'http://www.nytimes.com/c/%03d.html' % i})
+    mock_table.insert_many(records)
+    vec = TfidfVectorizer().fit([r['clean_text'] for r in records])
+    nmf = NMF(4, random_state=0).fit(vec.transform(
+        [r['clean_text'] for r in records]))
+    analyzer = analysis.TopicAnalyzer(None, None)
+    analyzer._vectorizer, analyzer._H = vec, nmf.components_
+    return analyzer
+
+
+def test_current_events_window_empty():
+    window = analysis.CurrentEventsWindow([1., 2., 3.], min_articles=0,
+                                          spike_ratio=0.)
+    assert window.flagged() == []
+
+
+def test_current_events_window_flags_spike():
+    window = analysis.CurrentEventsWindow([1., 1., 1.], n_days=2,
+                                          min_articles=2)
+    window.add('old', '2014-11-01', [1., 0., 0.])
+    window.add('a', '2014-11-10', [0., 0., .9])
+    assert window.flagged() == []
+    window.add('b', '2014-11-11', [.1, 0., .5])
+    assert len(window) == 2
+    flagged = window.flagged()
+    assert [(t, best) for t, _, _, best in flagged] == [(2, 'a')]
+    assert np.isclose(flagged[0][1], 1.4 / 1.5)
+
+
+def _weights_table(table, model_name='model', n=40, num_topics=5, seed=0):
+    '''
+    Fills table with n News articles holding dense random weights for
+        model_name, one every ten days from 2002-01-01, and returns
+        (ids, pub_dates, weights).
+    '''
+    rng = np.random.RandomState(seed)
+    weights = rng.rand(n, num_topics)
+    ids = ['a%02d' % i for i in xrange(n)]
+    pub_dates = [date.fromordinal(date(2002, 1, 1).toordinal() + 10 * i)
+                 .isoformat() + 'T00:00:00Z' for i in xrange(n)]
+    table.insert_many([{'_id': i, 'pub_date': d, 'type_of_material': 'News',
+                        model_name: list(w)}
+                       for i, d, w in zip(ids, pub_dates, weights)])
+    return np.array(ids), pub_dates, weights
+
+
+def test_top_k_indices_matches_argsort():
+    weights = np.random.RandomState(1).rand(200, 6)
+    for k in [1, 10, 200, 500]:
+        full = np.argsort(-weights, axis=0)[:k]
+        assert (analysis.top_k_indices(weights, k) == full).all()
+        assert (analysis.top_k_indices(weights[:, 2], k) == full[:, 2]).all()
+    assert analysis.top_k_indices(weights[:0], 3).shape == (0, 6)
+
+
+def test_streaming_top_k_matches_full():
+    rng = np.random.RandomState(2)
+    weights = rng.rand(503, 4)
+    ids = np.arange(503) * 3
+    for k, chunk in [(10, 50), (10, 1), (25, 503), (600, 64)]:
+        chunks = [(ids[s:s + chunk], weights[s:s + chunk])
+                  for s in xrange(0, len(ids), chunk)]
+        best_ids, best_w = analysis.streaming_top_k(chunks, k)
+        full = np.argsort(-weights, axis=0)[:k]
+        assert (best_ids == ids[full]).all()
+        assert (best_w == weights[full, np.arange(4)]).all()
+    best_ids, best_w = analysis.streaming_top_k([], 10, 4)
+    assert best_ids.shape == best_w.shape == (0, 4)
+
+
+def test_get_best_articles_overall_chunked(mock_table):
+    ids, _, weights = _weights_table(mock_table)
+    topics = ['t%d' % t for t in xrange(weights.shape[1])]
+    full = analysis.get_best_articles_overall(mock_table, 'model', topics,
+                                              '2002', '2003', top_count=5)
+    chunked = analysis.get_best_articles_overall(
+        mock_table, 'model', topics, '2002', '2003', top_count=5,
+        chunk_size=7)
+    in_range = np.array([i < 37 for i in xrange(len(ids))])
+    for t, topic in enumerate(topics):
+        expected = ids[in_range][np.argsort(-weights[in_range, t])[:5]]
+        assert list(full[topic]) == list(chunked[topic]) == list(expected)
+
+
+def test_get_best_articles_overall_chunked_empty(mock_table):
+    _weights_table(mock_table)
+    topics = ['t%d' % t for t in xrange(5)]
+    best = analysis.get_best_articles_overall(mock_table, 'model', topics,
+                                              '1990', '1991', chunk_size=7)
+    assert sorted(best) == topics
+    assert all(len(v) == 0 for v in best.values())
+
+
+@pytest.mark.parametrize('only_best_match', [True, False])
+def test_empire_plot_counts_single_pass(mock_table, corpus, only_best_match):
+    kwargs = {'only_best_match': only_best_match,
+              'doc_topic_threshold': .02}
+    per_month = corpus.empire_plot_counts(mock_table, '2002-01', '2002-06',
+                                          **kwargs)
+    single = corpus.empire_plot_counts(mock_table, '2002-01', '2002-06',
+                                       single_pass=True, **kwargs)
+    assert sorted(per_month) == sorted(single)
+    assert all(list(per_month[m]) == list(single[m]) for m in per_month)
+    assert sum(sum(c) for c in single.values()) > 0
+
+
+def test_empire_plot_counts_cube(mock_table, corpus):
+    cube = corpus.build_cube(mock_table, batch_size=50)
+    per_month = corpus.empire_plot_counts(mock_table, '2002-01', '2002-06')
+    for single_pass in [False, True]:
+        from_cube = corpus.empire_plot_counts(mock_table, '2002-01',
+                                              '2002-06', cube=cube,
+                                              single_pass=single_pass)
+        assert all(list(per_month[m]) == list(from_cube[m])
+                   for m in per_month)
+
+
+def _stored_weights(table, model_name):
+    '''
+    Stored weights of model_name keyed by _id, decoded.
+    '''
+    records = list(table.find({model_name: {'$exists': True}},
+                              {model_name: 1}))
+    weights = decode_topic_weights([r[model_name] for r in records])
+    return dict(zip([r['_id'] for r in records], weights))
+
+
+@pytest.mark.parametrize('n_jobs', [None, 2])
+def test_store_topic_weights_batched(mock_table, corpus, tmpdir, n_jobs):
+    corpus.store_topic_weights(mock_table, 'one', min_doc_length=10)
+    corpus.store_topic_weights(mock_table, 'many', min_doc_length=10,
+                               batch_size=7, n_jobs=n_jobs,
+                               cache_dir=str(tmpdir))
+    one, many = _stored_weights(mock_table, 'one'), \
+        _stored_weights(mock_table, 'many')
+    assert 0 < len(one) < mock_table.count_documents({})
+    assert sorted(one) == sorted(many)
+    assert all(np.allclose(one[i], many[i]) for i in one)
+
+    cache = TopicWeightStore(str(tmpdir), 'many')
+    assert sorted(cache.ids) == sorted(many)
+    records = dict((r['_id'], r) for r in mock_table.find())
+    for i, pub_date, kind, w in zip(cache.ids, cache.pub_dates, cache.types,
+                                    cache.weights):
+        assert pub_date == records[i]['pub_date']
+        assert kind == records[i]['type_of_material']
+        assert np.allclose(w, many[i])
+
+
+@pytest.mark.parametrize('top_k', [None, 2])
+def test_topic_weight_cache_matches_mongo(mock_table, corpus, tmpdir,
+                                          top_k):
+    corpus.store_topic_weights(mock_table, 'model', top_k=top_k)
+    cache_dir = str(tmpdir.join('cache'))
+    cache = cache_topic_weights(mock_table, 'model', cache_dir)
+    assert len(cache) == mock_table.count_documents({})
+
+    query = {'$gte': '2002-02', '$lt': '2002-05'}
+    ids, dates, weights = analysis._load_topic_weights(mock_table, 'model',
+                                                       query)
+    c_ids, c_dates, c_weights = analysis._load_topic_weights(
+        mock_table, 'model', query, cache_dir)
+    order, c_order = np.argsort(ids), np.argsort(c_ids)
+    assert 0 < len(ids) < mock_table.count_documents({})
+    assert list(ids[order]) == list(c_ids[c_order])
+    assert list(dates[order]) == list(c_dates[c_order])
+    assert np.allclose(weights[order], c_weights[c_order], rtol=1e-6)
+    assert np.allclose(
+        analysis._topic_weight_totals(mock_table, 'model', query),
+        analysis._topic_weight_totals(mock_table, 'model', query, cache_dir))
+
+    topics = ['t%d' % t for t in xrange(corpus.num_topics)]
+    from_mongo = analysis.get_best_articles_overall(
+        mock_table, 'model', topics, '2002-01', '2002-07', top_count=5)
+    from_cache = analysis.get_best_articles_overall(
+        mock_table, 'model', topics, '2002-01', '2002-07', top_count=5,
+        cache_dir=cache_dir)
+    assert all(list(from_mongo[t]) == list(from_cache[t]) for t in topics)
+
+    from_mongo = analysis.get_best_articles_per_month(
+        mock_table, 'model', '2002-01', '2002-06')
+    from_cache = analysis.get_best_articles_per_month(
+        mock_table, 'model', '2002-01', '2002-06', cache_dir=cache_dir)
+    assert sorted(from_mongo) == sorted(from_cache)
+    for month in from_mongo:
+        assert [b[0] for b in from_mongo[month]] == \
+            [b[0] for b in from_cache[month]]
+
+    for name, cached in [('mongo.csv', None), ('cache.csv', cache_dir)]:
+        analysis.smooth_time_series(mock_table, 'model', topics,
+                                    str(tmpdir.join(name)), cache_dir=cached)
+    from_mongo, from_cache = [pd.read_csv(str(tmpdir.join(name)))
+                              for name in ['mongo.csv', 'cache.csv']]
+    assert from_mongo.equals(from_cache)
+
+
+def test_compile_best_article_json(mock_table, corpus, tmpdir):
+    corpus.store_topic_weights(mock_table, 'model')
+    topics = ['t%d' % t for t in xrange(corpus.num_topics)]
+
+    def article(record):
+        return {'pub_date': record['pub_date'][:10],
+                'lead_paragraph': record['lead_paragraph'],
+                'headline': record['headline'],
+                'web_url': record['web_url']}
+
+    overall = analysis.get_best_articles_overall(mock_table, 'model', topics,
+                                                 '2002-01', '2002-07',
+                                                 top_count=3)
+    outputfile = str(tmpdir.join('overall.json'))
+    analysis.compile_overall_best_article_json(mock_table, 'model', overall,
+                                               topics, outputfile)
+    expected = dict((t, [article(mock_table.find_one({'_id': a}))
+                         for a in overall[t]]) for t in topics)
+    with open(outputfile) as f:
+        assert json.load(f) == expected
+
+    monthly = analysis.get_best_articles_per_month(mock_table, 'model',
+                                                   '2002-01', '2002-06')
+    outputfile = str(tmpdir.join('monthly.json'))
+    analysis.compile_best_article_json(mock_table, 'model', monthly, topics,
+                                       outputfile)
+    expected = dict((t, []) for t in topics)
+    for month, bests in monthly.iteritems():
+        for t, (a, weight) in zip(topics, bests):
+            record = mock_table.find_one({'_id': a})
+            expected[t].append(dict(article(record), weight=weight, _id=a,
+                                    weights_sum=sum(record['model'])))
+    with open(outputfile) as f:
+        compiled = json.load(f)
+    assert sorted(compiled) == topics
+    for t in topics:
+        assert len(compiled[t]) == len(expected[t]) == 6
+        for got, want in zip(compiled[t], expected[t]):
+            assert np.isclose(got.pop('weights_sum'),
+                              want.pop('weights_sum'))
+            assert got == want
+
+
+def test_smooth_time_series_sparse_weights(mock_table, corpus, tmpdir):
+    corpus.store_topic_weights(mock_table, 'model', top_k=2)
+    topics = ['t%d' % t for t in xrange(corpus.num_topics)]
+    outputfile = str(tmpdir.join('series.csv'))
+    analysis.smooth_time_series(mock_table, 'model', topics, outputfile,
+                                rank_number=3, month_interval=1)
+    series = pd.read_csv(outputfile, index_col='date')
+
+    expected = pd.DataFrame(0, index=['2002-%02d' % m for m in xrange(1, 7)],
+                            columns=topics)
+    news = {'model': {'$exists': True}, 'type_of_material': 'News'}
+    for r in mock_table.find(news):
+        weights = decode_topic_weights([r['model']])[0]
+        for t in np.flatnonzero(weights > 0):
+            expected.loc[r['pub_date'][:7], topics[t]] += 1
+    assert (series.values == expected.values).all()
+
+
+def _assert_same_cube(cube, expected):
+    assert cube.first_day == expected.first_day
+    assert cube.last_date == expected.last_date
+    for name in TopicCube.STATS:
+        assert np.allclose(getattr(cube, name), getattr(expected, name))
+
+
+def test_cube_increments(mock_table, corpus, tmpdir):
+    expected = corpus.build_cube(mock_table)
+    table = mock_table.database.incremental
+    records = sorted(mock_table.find(), key=lambda r: r['pub_date'])
+    table.insert_many(records[:70])
+    cube = corpus.build_cube(table, batch_size=16)
+    assert cube.last_date == records[69]['pub_date']
+    cube.save(str(tmpdir))
+    cube = TopicCube.load(str(tmpdir))
+
+    table.insert_many(records[70:])
+    corpus.add_to_cube(cube, table, batch_size=16)
+    _assert_same_cube(cube, expected)
+    corpus.add_to_cube(cube, table)
+    _assert_same_cube(cube, expected)
+
+
+def test_cube_from_store_added_once(mock_table, corpus, tmpdir):
+    records = list(mock_table.find())
+    texts = [r['clean_text'] for r in records]
+    store = save_features(str(tmpdir), corpus.vectorizer.transform(texts),
+                          [r['_id'] for r in records],
+                          [r['pub_date'] for r in records],
+                          corpus.vectorizer, [len(t.split()) for t in texts])
+    expected = corpus.build_cube(mock_table)
+    cube = corpus.build_cube(None, store=store, batch_size=16)
+    _assert_same_cube(cube, expected)
+    corpus.add_to_cube(cube, None, store=store)
+    _assert_same_cube(cube, expected)
+    with pytest.raises(ValueError):
+        corpus.add_to_cube(cube, None, {'pub_date': {'$gte': '2002'}}, store)
+
+
+@pytest.mark.parametrize('normalize,n_jobs', [('linear', None),
+                                              ('sqrt', 2), ('none', None)])
+def test_store_topic_weights_fills_cube(mock_table, corpus, normalize,
+                                        n_jobs):
+    expected = corpus.build_cube(mock_table)
+    cube = TopicCube(corpus.num_topics)
+    corpus.store_topic_weights(mock_table, 'model', normalize=normalize,
+                               batch_size=16, n_jobs=n_jobs, top_k=2,
+                               cube=cube)
+    _assert_same_cube(cube, expected)
+    corpus.add_to_cube(cube, mock_table)
+    _assert_same_cube(cube, expected)
+
+
+@pytest.mark.parametrize('vectorizer', ['tfidf', 'hashing'])
+def test_model_artifacts_roundtrip(mock_table, corpus, tmpdir, vectorizer):
+    texts = [r['clean_text'] for r in mock_table.find()]
+    if vectorizer == 'tfidf':
+        vec = TfidfVectorizer(ngram_range=(1, 2), max_df=.8,
+                              max_features=40, sublinear_tf=True)
+    else:
+        vec = HashingTfidf(n_features=2 ** 10, ngram_range=(1, 2))
+    X = vec.fit_transform(texts)
+    H = NMF(5, random_state=0).fit(X).components_
+    topic_filter = np.array([True, False, True, True, False])
+    for name, obj in [('vec.pkl', vec), ('H.pkl', H)]:
+        with open(str(tmpdir.join(name)), 'w') as f:
+            pickle.dump(obj, f)
+    pickled = analysis.TopicAnalyzer(str(tmpdir.join('vec.pkl')),
+                                     str(tmpdir.join('H.pkl')), topic_filter)
+    path = str(tmpdir.join('artifacts'))
+    pickled.save_artifacts(path)
+
+    mapped = analysis.TopicAnalyzer.from_artifacts(path)
+    assert (mapped.topic_filter == topic_filter).all()
+    assert mapped.num_topics == 3
+    assert np.array_equal(mapped.H, H[topic_filter])
+    assert vectorizer_fingerprint(mapped.vectorizer) == \
+        vectorizer_fingerprint(vec)
+    assert (mapped.vectorizer.transform(texts) !=
+            vec.transform(texts)).nnz == 0
+    assert mapped.vectorizer.get_feature_names() == vec.get_feature_names()
+    save_model_artifacts(str(tmpdir.join('direct')), vec, H, topic_filter)
+    direct = analysis.TopicAnalyzer.from_artifacts(str(tmpdir.join('direct')))
+    assert np.array_equal(direct.H, H[topic_filter])
+    assert (direct.topic_filter == topic_filter).all()
+
+    pickled.store_topic_weights(mock_table, 'pickled')
+    mapped.store_topic_weights(mock_table, 'mapped', n_jobs=2,
+                               batch_size=16)
+    pickled = _stored_weights(mock_table, 'pickled')
+    mapped = _stored_weights(mock_table, 'mapped')
+    assert sorted(pickled) == sorted(mapped)
+    assert all(np.allclose(pickled[i], mapped[i]) for i in pickled)
+
+
+def test_current_events_analysis(mock_table, corpus):
+    corpus.store_topic_weights(mock_table, 'model')
+    spike = ' '.join(WORDS[6:12])  # the anthrax topic words
+    mock_table.insert_many([{'_id': 's%d' % i, 'clean_text': spike,
+                             'pub_date': '2002-06-%02dT12:00:00Z' % (25 + i),
+                             'type_of_material': 'News'}
+                            for i in xrange(4)])
+    flagged, window = corpus.current_events_analysis(
+        mock_table, 'model', n_days=10, spike_ratio=1.5, min_articles=1,
+        end_date='2002-06-30T00:00:00Z')
+
+    # the window holds the News articles of 2002-06-21 through 2002-06-30
+    in_window = [r for r in mock_table.find({'type_of_material': 'News'})
+                 if '2002-06-21' <= r['pub_date'] < '2002-07']
+    assert len(window) == len(in_window) > 4
+    newest = max(r['pub_date'] for r in in_window)
+    assert window.today == analysis._day_number(newest)
+    assert min(window._days) >= date(2002, 6, 21).toordinal()
+
+    # the baseline is the stored weights of News articles before then
+    before = [r['model'] for r in mock_table.find(
+        {'type_of_material': 'News', 'pub_date': {'$lt': '2002-06-21'},
+         'model': {'$exists': True}})]
+    baseline = np.sum(before, axis=0)
+    assert np.allclose(window.baseline, baseline / baseline.sum())
+
+    texts = [r['clean_text'] for r in in_window]
+    scores = corpus.vectorizer.transform(texts).dot(corpus.H.T) / \
+        np.array([[len(t.split())] for t in texts], dtype=float)
+    shares = scores.sum(axis=0) / scores.sum()
+    ratios = shares / window.baseline
+    hot = [t for t in np.argsort(-ratios) if ratios[t] >= 1.5]
+    assert hot
+    assert [f[0] for f in flagged] == hot
+    for t, share, base, best in flagged:
+        assert np.isclose(share, shares[t])
+        assert best == in_window[scores[:, t].argmax()]['_id']
+    spike_topic = corpus.vectorizer.transform([spike]).dot(
+        corpus.H.T).argmax()
+    assert spike_topic in hot
+
+
+def test_current_events_analysis_no_dates(mock_table, corpus):
+    with pytest.raises(ValueError):
+        corpus.current_events_analysis(mock_table.database.empty, 'model')
+
+
+def _loop_spikes(x, window, z_threshold, min_value):
+    '''
+    detect_spikes one topic and one row at a time.
+    '''
+    spikes = []
+    for t in xrange(x.shape[1]):
+        flags = []
+        for i in xrange(len(x)):
+            z = np.nan
+            if i >= window:
+                history = x[i - window:i, t]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    z = (x[i, t] - history.mean()) / np.float64(history.std())
+            flags.append(z >= z_threshold and x[i, t] > min_value)
+        i = 0
+        while i < len(x):
+            if flags[i]:
+                j = i
+                while j + 1 < len(x) and flags[j + 1]:
+                    j += 1
+                spikes.append((t, i, j, i + int(np.argmax(x[i:j + 1, t]))))
+                i = j
+            i += 1
+    return spikes
+
+
+def test_detect_spikes_matches_loop():
+    rng = np.random.RandomState(3)
+    x = rng.rand(60, 5)
+    x[30:33, 1] += [3., 5., 4.]          # a three-month run
+    x[:, 2] = 2.
+    x[20, 2], x[40:42, 2] = 6., [1., 9.]  # rises after flat histories
+    x[:, 3] = 0.
+    x[50, 3] = 1.
+    for window, z_threshold, min_value in [(12, 3., 0.), (6, 2., .5),
+                                           (12, 1., 2.5), (70, 3., 0.)]:
+        spikes = analysis.detect_spikes(x, window, z_threshold, min_value)
+        assert spikes == _loop_spikes(x, window, z_threshold, min_value)
+    spikes = analysis.detect_spikes(x, 12)
+    assert (1, 30, 31, 31) in spikes  # 32 has the spike in its history
+    assert (2, 20, 20, 20) in spikes and (3, 50, 50, 50) in spikes
+
+
+def test_spike_articles_json(mock_table, tmpdir):
+    rng = np.random.RandomState(4)
+    records = []
+    for m in xrange(24):
+        month = '%d-%02d' % (2002 + m // 12, m % 12 + 1)
+        for i in xrange(10):
+            weights = rng.rand(4) * .05
+            weights[0] += .2
+            if month in ('2003-04', '2003-05') and i < 8:
+                weights[2] = .3 + rng.rand()
+            records.append({'_id': '%s-%d' % (month, i),
+                            'pub_date': '%s-%02dT00:00:00Z' % (month, i + 1),
+                            'type_of_material': 'News',
+                            'model': list(weights),
+                            'headline': {'main': 'Headline %s %d' % (month, i)},
+                            'lead_paragraph': 'Lead %s %d' % (month, i),
+                            'web_url': 'http://www.nytimes.com/%s/%d.html'
+                                       % (month, i)})
+    mock_table.insert_many(records)
+    topics = ['t%d' % t for t in xrange(4)]
+    spikes = analysis.get_spike_articles(mock_table, 'model', topics,
+                                         top_k=3, window=6, month_interval=2,
+                                         ranked=False, topic_threshold=.1)
+    assert [t for t in topics if spikes[t]] == ['t2']
+    by_id = dict((r['_id'], r) for r in records)
+    linked = [by_id[a] for _, a in spikes['t2']]
+    assert len(linked) == 3
+    # a spike's articles come from its months and the month before
+    assert all('2003-03' <= r['pub_date'][:7] <= '2003-06' for r in linked)
+    strongest = sorted((r for r in records if r['pub_date'] < '2003-07' and
+                        r['pub_date'] >= '2003-03'),
+                       key=lambda r: -r['model'][2])[:3]
+    assert [r['_id'] for r in linked] == [r['_id'] for r in strongest]
+
+    outputfile = str(tmpdir.join('spikes.json'))
+    analysis.compile_spike_article_json(mock_table, spikes, outputfile)
+    with open(outputfile) as f:
+        compiled = json.load(f)
+    assert sorted(compiled) == topics
+    peak = spikes['t2'][0][0]
+    assert compiled['t2'] == [{'pub_date': r['pub_date'][:10],
+                               'lead_paragraph': r['lead_paragraph'],
+                               'headline': r['headline'],
+                               'web_url': r['web_url'], 'spike': peak}
+                              for r in linked]
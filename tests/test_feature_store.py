@@ -0,0 +1,40 @@
+'''
+Tests for feature_store: the on-disk feature matrix.
+'''
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from feature_store import save_features, FeatureStore
+
+TEXTS = ['towers fell', 'rescue workers towers', 'memorial opens',
+         'memorial fund workers']
+PUB_DATES = ['2001-09-12', '2001-09-11', '2011-09-11', '2002-01-05']
+
+
+@pytest.fixture
+def vec():
+    return TfidfVectorizer().fit(TEXTS)
+
+
+def test_save_features_roundtrip(tmpdir, vec):
+    X = vec.transform(TEXTS)
+    store = save_features(str(tmpdir), X, ['a', 'b', 'c', 'd'], PUB_DATES,
+                          vec, [len(t.split()) for t in TEXTS])
+    store.check(vec, lengths=True)
+    rows, ids, lengths = store.rows(0, len(store))
+    order = np.argsort(PUB_DATES)
+    assert list(ids) == ['b', 'a', 'd', 'c']
+    assert (rows != sp.csr_matrix(X)[order]).nnz == 0
+    assert lengths.ravel().tolist() == [3., 2., 3., 2.]
+    _, ids, _ = FeatureStore(str(tmpdir)).date_range('2001-09', '2001-12')
+    assert list(ids) == ['b', 'a']
+
+
+def test_save_features_without_lengths(tmpdir, vec):
+    store = save_features(str(tmpdir), vec.transform(TEXTS),
+                          range(len(TEXTS)), PUB_DATES, vec)
+    store.check(vec)
+    assert store.rows(0, 2)[2] is None
+    with pytest.raises(ValueError):
+        store.check(vec, lengths=True)
@@ -0,0 +1,83 @@
+'''
+Tests for mongo_stuff: the reports, projections and indexes, on mongomock
+    and (when one is running) a real mongod.
+'''
+import pytest
+from pymongo import ASCENDING
+import mongo_stuff
+
+RECORDS = [{'_id': 'r%d' % i,
+            'pub_date': '2002-%02d-%02dT00:00:00Z' % (i % 4 + 1, i % 28 + 1),
+            'type_of_material': 'News' if i % 3 else 'Op-Ed',
+            'web_url': 'http://www.nytimes.com/r/%d.html' % i,
+            'full_text': 'full text %d' % i,
+            'clean_text': ['', 'clean text %d' % i, None][i % 3]}
+           for i in xrange(30)]
+
+
+@pytest.fixture(params=['mock_table', 'mongod_table'])
+def table(request):
+    '''
+    The RECORDS, with clean_text left out where it is None, in mongomock
+        and in a real mongod.
+    '''
+    table = request.getfixturevalue(request.param)
+    table.insert_many([dict((k, v) for k, v in r.iteritems()
+                            if v is not None) for r in RECORDS])
+    return table
+
+
+@pytest.mark.parametrize('query', [{}, {'type_of_material': 'News'},
+                                   {'pub_date': {'$gte': '2002-03'}}])
+def test_records_by_month_agg(table, query):
+    counts = mongo_stuff.records_by_month(table, query)
+    assert mongo_stuff.records_by_month_agg(table, query) == counts
+    assert sum(counts.values()) == table.count_documents(query)
+
+
+def test_ensure_indexes(table):
+    names = mongo_stuff.ensure_indexes(table, ['model', 'other'])
+    assert names == mongo_stuff.ensure_indexes(table, ['model', 'other'])
+    info = table.index_information()
+    for keys, options in mongo_stuff.RECOMMENDED_INDEXES:
+        index = [i for i in info.values() if i['key'] == keys]
+        assert len(index) == 1
+        assert index[0].get('unique', False) == options.get('unique', False)
+    for model_name in ['model', 'other']:
+        assert info[model_name + '_pub_date']['key'] == [
+            ('pub_date', ASCENDING), ('type_of_material', ASCENDING),
+            (model_name + '.n', ASCENDING)]
+
+
+def test_ensure_indexes_partial(mongod_table):
+    '''
+    mongomock ignores partialFilterExpression, so this needs a mongod.
+    '''
+    mongo_stuff.ensure_indexes(mongod_table, ['model', 'other'])
+    info = mongod_table.index_information()
+    for model_name in ['model', 'other']:
+        assert info[model_name + '_pub_date']['partialFilterExpression'] \
+            == {model_name: {'$exists': True}}
+
+
+def test_just_clean_text(table):
+    query = {'type_of_material': 'News'}
+    docs = mongo_stuff.just_clean_text(table, query)
+    assert query == {'type_of_material': 'News'}
+    expected = [(r['_id'], r['clean_text']) for r in RECORDS
+                if r['type_of_material'] == 'News' and r['clean_text']]
+    assert sorted(docs) == sorted(expected)
+
+
+def test_records_by_id(table):
+    ids = ['r3', 'r4', None, 'r3', 'r29', 'missing']
+    records = mongo_stuff.records_by_id(table, ids, ['pub_date'],
+                                        chunk_size=2)
+    assert sorted(records) == ['r29', 'r3', 'r4']
+    assert records['r4'] == {'_id': 'r4', 'pub_date': RECORDS[4]['pub_date']}
+
+
+def test_batches():
+    assert list(mongo_stuff.batches(xrange(7), 3)) == [[0, 1, 2], [3, 4, 5],
+                                                       [6]]
+    assert list(mongo_stuff.batches([], 3)) == []
@@ -0,0 +1,212 @@
+'''
+Tests for nlp: the tokenizer backends against a golden corpus,
+    topic_parse against the full sort it replaced, minibatch_nmf,
+    HashingTfidf and the incremental topic update.
+'''
+import json
+import os
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+import nlp
+from feature_store import save_features
+
+GOLDEN_TOKENS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'data', 'golden_tokens.json')
+
+
+def _golden_cases():
+    '''
+    (doc, expected tokens) pairs from the golden corpus; docs flagged
+        'bytes' are fed in as utf-8 encoded strings.
+    '''
+    with open(GOLDEN_TOKENS) as f:
+        cases = json.load(f)
+    return [(c['doc'].encode('utf-8') if c['bytes'] else c['doc'],
+             c['tokens']) for c in cases]
+
+
+@pytest.mark.parametrize('backend', sorted(nlp.TOKENIZERS))
+@pytest.mark.parametrize('doc,expected', _golden_cases())
+def test_clean_tokenize_golden(backend, doc, expected):
+    assert nlp.clean_tokenize(doc, backend) == expected
+
+
+class _Vocabulary(object):
+    '''
+    Stands in for a fitted vectorizer in topic_parse.
+    '''
+    def __init__(self, n_features):
+        self.names = ['term%03d' % i for i in xrange(n_features)]
+
+    def get_feature_names(self):
+        return self.names
+
+
+def _sorted_topic_parse(vec, H, n_top_words=20):
+    '''
+    topic_parse as it was before argpartition: a full sort per topic.
+    '''
+    topics_dicts = []
+    for i in xrange(H.shape[0]):
+        k, v = zip(*sorted(zip(vec.get_feature_names(), H[i]),
+                           key=lambda x: x[1])[:-n_top_words:-1])
+        val_arr = np.array(v)
+        norms = val_arr / np.sum(val_arr)
+        topics_dicts.append(dict(zip(k, norms * 100)))
+    return topics_dicts
+
+
+@pytest.mark.parametrize('n_top_words', [2, 5, 20, 60, 61, 100])
+def test_topic_parse_matches_sort(n_top_words):
+    rng = np.random.RandomState(n_top_words)
+    H = np.vstack([rng.randint(0, 4, size=(6, 60)).astype(float),
+                   np.zeros((1, 60)), rng.rand(2, 60)])
+    vec = _Vocabulary(H.shape[1])
+    expected = _sorted_topic_parse(vec, H, n_top_words)
+    parsed = nlp.topic_parse(vec, H, n_top_words)
+    assert len(parsed) == len(expected)
+    for got, want in zip(parsed, expected):
+        assert sorted(got) == sorted(want)
+        assert np.allclose([got[k] for k in sorted(want)],
+                           [want[k] for k in sorted(want)], equal_nan=True)
+
+
+@pytest.mark.parametrize('n_top_words', [0, 1])
+def test_topic_parse_no_words(n_top_words):
+    H = np.random.RandomState(0).rand(3, 10)
+    assert nlp.topic_parse(_Vocabulary(10), H, n_top_words) == [{}, {}, {}]
+
+
+def test_minibatch_nmf_keeps_early_topics(tmpdir):
+    '''
+    Articles from the first half of the store use topics the second half
+        never does; a decayed fit in date order would forget them.
+    '''
+    rng = np.random.RandomState(0)
+    X = np.zeros((2000, 120))
+    for i in xrange(len(X)):
+        t = rng.randint(3) + (0 if i < 1000 else 3)
+        X[i, t * 20:(t + 1) * 20] = rng.rand(20) * (rng.rand(20) < .5)
+    pub_dates = ['%d-01-01' % (2001 + i // 200) for i in xrange(len(X))]
+    store = save_features(str(tmpdir), sp.csr_matrix(X), range(len(X)),
+                          pub_dates)
+    W, H, trace = nlp.minibatch_nmf(store, 6, 50, n_epochs=3, forget=.5,
+                                    random_state=0)
+    assert W.shape == (2000, 6) and H.shape == (6, 120)
+    error = ((X - W.dot(H)) ** 2).sum(axis=1) / (X ** 2).sum(axis=1)
+    assert error[:1000].mean() < .8
+    assert error[1000:].mean() < .8
+
+
+def _hashing_docs(n=60):
+    '''
+    Small corpus where 'common' is in every document and the rest rotate.
+    '''
+    words = ['river', 'bank', 'market', 'stock', 'vote', 'senate', 'storm',
+             'flood']
+    return ['common %s %s %s' % (words[i % 8], words[(i * 3 + 1) % 8],
+                                 words[(i * 5 + 2) % 8]) for i in xrange(n)]
+
+
+def test_hashing_tfidf_chunks_match_serial():
+    docs = _hashing_docs()
+    serial = nlp.HashingTfidf(n_features=2 ** 12, ngram_range=(1, 2))
+    pooled = nlp.HashingTfidf(n_features=2 ** 12, ngram_range=(1, 2),
+                              n_jobs=2, chunk_size=7)
+    X = serial.fit_transform(docs)
+    assert abs(pooled.fit_transform(docs) - X).max() < 1e-12
+    np.testing.assert_array_equal(pooled.idf_, serial.idf_)
+    assert abs(pooled.transform(docs[:20]) - serial.transform(docs[:20])) \
+        .max() < 1e-12
+
+
+def test_hashing_tfidf_max_df_drops_common_columns():
+    vec = nlp.HashingTfidf(n_features=2 ** 12, max_df=.5)
+    X = vec.fit_transform(_hashing_docs()).tocsc()
+    col = dict((t, c) for c, t in vec.terms.iteritems())
+    assert vec.idf_[col['common']] == 0
+    assert X[:, col['common']].nnz == 0
+    assert vec.idf_[col['river']] > 0
+    assert X[:, col['river']].nnz > 0
+
+
+def test_hashing_tfidf_names_are_ngrams():
+    docs = _hashing_docs()
+    vec = nlp.HashingTfidf(n_features=2 ** 12, ngram_range=(1, 2), max_df=1.)
+    vec.fit(docs)
+    analyze = vec.hasher.build_analyzer()
+    X = vec.transform(docs[:1])
+    names = vec.get_feature_names()
+    assert len(names) == 2 ** 12
+    assert set(names[c] for c in X.indices) == set(analyze(docs[0]))
+
+    topics = nlp.topic_parse(vec, X.toarray(), n_top_words=X.nnz + 1)
+    assert set(topics[0]) == set(analyze(docs[0]))
+    assert any(' ' in term for term in topics[0])
+
+
+def test_docs_tfidf_hashing_default_width():
+    _, vec = nlp.docs_tfidf(_hashing_docs(), hashing=True)
+    assert vec.n_features == 2 ** 18
+    _, vec = nlp.docs_tfidf(_hashing_docs(), hashing=True, n_features=2 ** 10)
+    assert vec.n_features == 2 ** 10
+
+
+def _topic_matrix(seed=0):
+    '''
+    Exact rank 3 non-negative X = W H (sparse), with W and H.
+    '''
+    rng = np.random.RandomState(seed)
+    W = rng.rand(40, 3) * (rng.rand(40, 3) < .6)
+    H = rng.rand(3, 30) * (rng.rand(3, 30) < .5)
+    return sp.csr_matrix(W.dot(H)), W, H
+
+
+def test_fold_in_nmf_recovers_w():
+    X, W, H = _topic_matrix()
+    W_fit = nlp.fold_in_nmf(X, H, n_iter=2000, tol=1e-10)
+    assert W_fit.shape == W.shape and (W_fit >= 0).all()
+    assert abs(W_fit.dot(H) - X.toarray()).max() < 1e-3
+
+
+def test_refit_topic_model_improves_warm_start():
+    X, W, H = _topic_matrix()
+    rng = np.random.RandomState(1)
+    W0, H0 = W + rng.rand(*W.shape) * .3, H + rng.rand(*H.shape) * .3
+    W1, H1 = nlp.refit_topic_model(X, W0, H0)
+    assert W1.shape == W.shape and H1.shape == H.shape
+    X = X.toarray()
+    assert (np.linalg.norm(X - W1.dot(H1)) <
+            .1 * np.linalg.norm(X - W0.dot(H0)))
+
+
+def test_update_idf_matches_refit_on_copy():
+    docs = _hashing_docs()
+    vec = TfidfVectorizer(max_df=1.).fit(docs[:20])
+    old_idf = vec.idf_.copy()
+    full = TfidfVectorizer(vocabulary=vec.vocabulary_).fit(docs)
+    doc_freqs = nlp.document_frequencies(full.transform(docs))
+    updated = nlp.update_idf(vec, doc_freqs, len(docs))
+    np.testing.assert_allclose(updated.idf_, full.idf_)
+    np.testing.assert_array_equal(vec.idf_, old_idf)
+
+
+def test_incremental_topic_update(mock_table):
+    docs = _hashing_docs()
+    mock_table.insert_many([{'_id': i, 'clean_text': doc, 'new': i >= 20}
+                            for i, doc in enumerate(docs)])
+    vec = TfidfVectorizer(max_df=1.).fit(docs[:20])
+    old_idf = vec.idf_.copy()
+    doc_freqs = nlp.document_frequencies(vec.transform(docs[:20]))
+    H = np.random.RandomState(0).rand(3, len(old_idf))
+    W, ids, doc_freqs, n_docs, new_vec = nlp.incremental_topic_update(
+        mock_table, vec, H, {'new': True}, doc_freqs, 20)
+    assert ids == range(20, len(docs)) and n_docs == len(docs)
+    np.testing.assert_array_equal(vec.idf_, old_idf)
+
+    full = TfidfVectorizer(vocabulary=vec.vocabulary_).fit(docs)
+    np.testing.assert_allclose(new_vec.idf_, full.idf_)
+    np.testing.assert_allclose(
+        W, nlp.fold_in_nmf(full.transform(docs[20:]), H), atol=1e-8)
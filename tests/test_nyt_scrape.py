@@ -0,0 +1,197 @@
+'''
+Tests for nyt_scrape: date window planning, the concurrent full-text
+    scraper against a local stub server, and bulk ingestion against
+    load_mongo.
+'''
+import threading
+import urlparse
+from datetime import date
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import pytest
+
+ARTICLE_HTML = '''<html><body>
+<p itemprop="articleBody">Story %s begins here.</p>
+<p itemprop="articleBody">It ends here.</p>
+</body></html>'''
+
+
+@pytest.fixture(scope='module')
+def nyt_scrape(tmpdir_factory):
+    '''
+    Imports nyt_scrape, which reads its API key from ./nytapi.txt.
+    '''
+    keydir = tmpdir_factory.mktemp('key')
+    keydir.join('nytapi.txt').write('test-key\n')
+    with keydir.as_cwd():
+        import nyt_scrape
+    return nyt_scrape
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub_server():
+    '''
+    Serves canned NYT article HTML at /article/<n> on localhost and
+        records every requested path.
+    '''
+    requested = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                requested.append(self.path)
+            body = ARTICLE_HTML % self.path.rsplit('/', 1)[-1]
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadedHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1], requested
+    server.shutdown()
+    server.server_close()
+
+
+def _yyyymmdd(s):
+    return date(int(s[:4]), int(s[4:6]), int(s[6:]))
+
+
+def _count_splits(per_day, first, last, max_hits):
+    '''
+    Splits a bisection of days first..last makes (per_day hits a day).
+    '''
+    hits = sum(per_day[first:last + 1])
+    if hits <= max_hits or first == last:
+        return 0
+    mid = (first + last) // 2
+    return (1 + _count_splits(per_day, first, mid, max_hits) +
+            _count_splits(per_day, mid + 1, last, max_hits))
+
+
+def test_plan_date_windows_counts_left_halves(nyt_scrape, monkeypatch):
+    '''
+    Each split costs one count query, and the windows cover every hit.
+    '''
+    start = date(2002, 1, 1)
+    per_day = [(i * 7) % 13 for i in xrange(60)]
+    urls = []
+
+    def count_query(url, session=None, limiter=None):
+        urls.append(url)
+        params = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+        first = (_yyyymmdd(params['begin_date']) - start).days
+        last = (_yyyymmdd(params['end_date']) - start).days
+        return sum(per_day[first:last + 1])
+
+    monkeypatch.setattr(nyt_scrape, 'count_query', count_query)
+    windows = nyt_scrape.plan_date_windows(
+        '', '20020101', '20020301', max_hits=50,
+        limiter=nyt_scrape.RateLimiter(1e6))
+    assert len(urls) == 1 + _count_splits(per_day, 0, 59, 50)
+    assert all(0 < hits <= 50 for _, _, hits in windows)
+    days = []
+    for begin, end, hits in windows:
+        first = (_yyyymmdd(begin) - start).days
+        last = (_yyyymmdd(end) - start).days
+        assert hits == sum(per_day[first:last + 1])
+        days.extend(xrange(first, last + 1))
+    assert days == sorted(set(days))
+    assert sum(per_day[d] for d in days) == sum(per_day)
+
+
+def test_parse_article_html(nyt_scrape):
+    story = nyt_scrape._parse_article_html(ARTICLE_HTML % 7)
+    assert story == 'Story 7 begins here. It ends here.'
+
+
+def test_scrape_full_texts_against_stub(nyt_scrape, stub_server, mock_table):
+    base, requested = stub_server
+    ignored = [{'_id': 'v%d' % i, 'full_text': '',
+                'web_url': 'http://www.nytimes.com/video/clip%d' % i}
+               for i in range(2)]
+    articles = [{'_id': 'a%d' % i, 'full_text': '',
+                 'web_url': '%s/article/%d' % (base, i)} for i in range(6)]
+    mock_table.insert_many(ignored + articles)
+
+    scraped, failed = nyt_scrape.scrape_full_texts(
+        mock_table, ignored + articles, n_workers=3, per_host=2,
+        max_requests=4)
+
+    assert len(requested) == 4
+    assert (scraped, failed) == (4, 2)
+    for d in ignored:
+        record = mock_table.find_one({'_id': d['_id']})
+        assert record['failed_scrape'] is True
+        assert record['full_text'] == ''
+    fetched = set(p.rsplit('/', 1)[-1] for p in requested)
+    for i, d in enumerate(articles):
+        record = mock_table.find_one({'_id': d['_id']})
+        if str(i) in fetched:
+            assert record['full_text'] == ('Story %d begins here. '
+                                           'It ends here.' % i)
+        else:
+            assert record['full_text'] == ''
+        assert 'failed_scrape' not in record
+
+
+def test_scrape_full_texts_without_budget(nyt_scrape, stub_server,
+                                          mock_table):
+    base, requested = stub_server
+    articles = [{'_id': 'a%d' % i, 'full_text': '',
+                 'web_url': '%s/article/%d' % (base, i)} for i in range(20)]
+    mock_table.insert_many(articles)
+
+    scraped, failed = nyt_scrape.scrape_full_texts(mock_table, articles,
+                                                   n_workers=4, per_host=2)
+
+    assert (scraped, failed) == (20, 0)
+    assert sorted(requested) == sorted('/article/%d' % i for i in range(20))
+
+
+def _ingest_docs():
+    '''
+    Article docs for the ingestion tests: d0-d19 are new apart from d3,
+        whose web_url is already stored, and d7, which repeats d6's
+        web_url within the batch.
+    '''
+    docs = [{'_id': 'd%d' % i, 'web_url': 'http://www.nytimes.com/a%d' % i,
+             'headline': {'main': 'headline %d' % i}} for i in range(20)]
+    docs[3]['web_url'] = 'http://www.nytimes.com/old'
+    docs[7]['web_url'] = docs[6]['web_url']
+    return docs
+
+
+@pytest.mark.parametrize('batch_size', [1000, 4])
+def test_load_mongo_bulk_matches_load_mongo(nyt_scrape, mongod_table,
+                                            batch_size):
+    existing = {'_id': 'old', 'web_url': 'http://www.nytimes.com/old',
+                'full_text': 'kept'}
+    mongod_table.insert_one(dict(existing))
+    expected = nyt_scrape.load_mongo(mongod_table, _ingest_docs())
+    expected_count = mongod_table.count_documents({})
+    expected_docs = sorted(mongod_table.find(), key=lambda d: d['_id'])
+
+    mongod_table.drop()
+    mongod_table.insert_one(dict(existing))
+    report = {}
+    ignore_ids = nyt_scrape.load_mongo_bulk(mongod_table, _ingest_docs(),
+                                            batch_size, report=report)
+
+    assert expected == set(['d3', 'd7'])
+    assert ignore_ids == expected
+    assert mongod_table.count_documents({}) == expected_count == 19
+    assert report == {'inserted': 18, 'skipped': 2}
+    assert sorted(mongod_table.find(),
+                  key=lambda d: d['_id']) == expected_docs